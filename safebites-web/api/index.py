@@ -1,16 +1,41 @@
 import os
+import sys
 import requests
 import math
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from dotenv import load_dotenv
-from functools import lru_cache
 from supabase import create_client, Client
 from datetime import datetime, timedelta, timezone
 from groq import Groq
 import json 
 import logging 
+import re
+import hashlib
+import hmac
+import time
+import copy
+from collections import OrderedDict, deque
+import threading
+import queue
+import unicodedata
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+import mmap
+import struct
+from array import array
+import bisect
+import heapq
+import random
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+try:
+    import numpy as np
+except ImportError:  # Optional: batched geo math falls back to pure Python
+    np = None
 
 # Setup Logger
 logger = logging.getLogger("uvicorn.error") # or just logging.getLogger(__name__)
@@ -46,6 +71,12 @@ class SearchRequest(BaseModel):
     filter_dedicated_gf: Optional[bool] = False
     filter_dedicated_fryer: Optional[bool] = False
     filter_gf_menu: Optional[bool] = False
+    # "places" (Google + DB) or "reviews" (full-text over stored reviews and summaries)
+    search_mode: Optional[str] = "places"
+    # --- OPENING HOURS ---
+    open_now: Optional[bool] = False
+    open_at: Optional[str] = None             # ISO datetime; no offset = the place's local wall clock
+    utc_offset_minutes: Optional[int] = None  # Caller's current offset, used for places without a time_zone
 
 class ReviewRequest(BaseModel):
     place_id: str # Google Place ID
@@ -58,8 +89,14 @@ class ReviewRequest(BaseModel):
     hours_schedule: Optional[List[str]] = None
     # Flag to force AI re-analysis (e.g. after user review)
     force_refresh: Optional[bool] = False
+    # With force_refresh: only re-score from community data, keep the stored Google analysis
+    community_only: Optional[bool] = False
+    # Admission control: premium users and detail pages are analyzed before card loads
+    user_id: Optional[str] = None
+    context: Optional[str] = "card"  # "detail" | "card" | "prefetch"
     lat: Optional[float] = None
     lng: Optional[float] = None
+    time_zone: Optional[str] = None  # IANA id from Places, e.g. "America/New_York"
 
 # 3. Helper Functions
 
@@ -85,36 +122,817 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     c = 2 * math.asin(math.sqrt(a)) 
     return c * 3956  # Radius of earth in miles
 
-# Function to convert address to lat/lon using Google Geocoding API
-@lru_cache(maxsize=100)
-def geocode_address(address: str):
-    """Converts a string address to lat/lon"""
-    if not GOOGLE_KEY: return None, None
+# --- BATCHED GEO MATH ---
+# Same haversine as calculate_distance, over whole candidate arrays in one call.
+EARTH_RADIUS_MILES = 3956
+MILES_PER_DEGREE_LAT = 69.0
+NUMPY_MIN_BATCH = 64  # Below this, array setup costs more than the scalar loop
+
+def _missing_coord(v):
+    # calculate_distance treats falsy coords (None / 0) as missing; keep that contract
+    return not v
+
+def bounding_box(lat: float, lon: float, radius_miles: float):
+    """(min_lat, max_lat, min_lng, max_lng) enclosing the radius; cheap pre-filter before trig"""
+    dlat = radius_miles / MILES_PER_DEGREE_LAT
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    dlng = min(radius_miles / (MILES_PER_DEGREE_LAT * cos_lat), 180.0)
+    return lat - dlat, lat + dlat, lon - dlng, lon + dlng
+
+def batch_distances(user_lat, user_lon, lats: List, lngs: List) -> List[Optional[float]]:
+    """Haversine miles from the user to every (lat, lng); None where coords are missing"""
+    if _missing_coord(user_lat) or _missing_coord(user_lon):
+        return [None] * len(lats)
+    if np is not None and len(lats) >= NUMPY_MIN_BATCH:
+        lat_arr = np.array([v if not _missing_coord(v) else np.nan for v in lats], dtype=float)
+        lng_arr = np.array([v if not _missing_coord(v) else np.nan for v in lngs], dtype=float)
+        lat1, lon1 = math.radians(user_lat), math.radians(user_lon)
+        lat2, lon2 = np.radians(lat_arr), np.radians(lng_arr)
+        a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        dist = 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_MILES
+        return [None if math.isnan(d) else float(d) for d in dist.tolist()]
+    return [calculate_distance(user_lat, user_lon, la, ln) for la, ln in zip(lats, lngs)]
+
+def geo_filter(user_lat, user_lon, lats: List, lngs: List, radius_miles: Optional[float] = None):
+    """
+    One call for the whole candidate set:
+    returns (distances, keep_indices) where keep_indices are the points inside the radius,
+    sorted nearest first. Points with missing coords get distance None and are kept
+    (unsorted, at the end) - same as the per-item loop, which never capped them.
+    """
+    if _missing_coord(user_lat) or _missing_coord(user_lon):
+        return [None] * len(lats), list(range(len(lats)))
+
+    distances = batch_distances(user_lat, user_lon, lats, lngs)
+    if np is not None and len(distances) >= NUMPY_MIN_BATCH:
+        arr = np.array([np.nan if d is None else d for d in distances], dtype=float)
+        known = ~np.isnan(arr)
+        inside = known & (arr <= radius_miles) if radius_miles is not None else known
+        idx = np.nonzero(inside)[0]
+        keep = idx[np.argsort(arr[idx], kind="stable")].tolist()
+        keep += np.nonzero(~known)[0].tolist()
+        return distances, keep
+
+    keep = [i for i, d in enumerate(distances) if d is not None and (radius_miles is None or d <= radius_miles)]
+    keep.sort(key=lambda i: distances[i])
+    keep += [i for i, d in enumerate(distances) if d is None]
+    return distances, keep
+
+def benchmark_geo(sizes=(30, 1000, 100000), repeat: int = 5):
+    """Micro-benchmark: scalar calculate_distance loop vs geo_filter (python api/index.py bench-geo)"""
+    rng = random.Random(42)
+    user_lat, user_lon = 33.749, -84.388
+    for n in sizes:
+        lats = [user_lat + rng.uniform(-1, 1) for _ in range(n)]
+        lngs = [user_lon + rng.uniform(-1, 1) for _ in range(n)]
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            scalar = [calculate_distance(user_lat, user_lon, la, ln) for la, ln in zip(lats, lngs)]
+            kept = sorted((i for i, d in enumerate(scalar) if d <= 30.0), key=lambda i: scalar[i])
+        scalar_ms = (time.perf_counter() - start) * 1000 / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            _, batched = geo_filter(user_lat, user_lon, lats, lngs, 30.0)
+        batch_ms = (time.perf_counter() - start) * 1000 / repeat
+
+        assert kept == batched
+        print(f"n={n:>7}  scalar {scalar_ms:9.3f} ms  batched {batch_ms:9.3f} ms  "
+              f"({'numpy' if np is not None else 'pure python'}, {len(kept)} within 30 mi)")
+
+# --- SHARED CACHE ---
+# One cache for every memoized upstream call (geocoding, Places, SerpApi, Groq).
+# Namespaces + TTLs + byte accounting + hit/miss stats, over interchangeable backends:
+#   memory   - per-process LRU (always used as L1 in front of the shared tier)
+#   disk     - SQLite file in CACHE_DIR, shared by every worker on the host
+#   supabase - `cache_entries` table, shared by every instance (the network store;
+#              set CACHE_BACKEND=disk or memory to stand it in locally). Create the table
+#              with CACHE_ENTRIES_DDL; until it exists the backend disables itself (L1 only).
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "supabase")
+CACHE_DIR = os.getenv("CACHE_DIR", "/tmp/safebites-cache")
+CACHE_MEMORY_MAX_BYTES = 16 * 1024 * 1024
+CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024
+CACHE_STORE_MAX_ROWS = 200000
+CACHE_PRUNE_EVERY_WRITES = 200  # Expiry + size bounds are enforced every N writes (soft bound)
+
+MISSING = object()
+
+class MemoryCacheBackend:
+    """Byte-bounded LRU. Entries: key -> (value, expires_at, size)"""
+
+    def __init__(self, max_bytes: int = CACHE_MEMORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: List[str]) -> dict:
+        now, found = time.time(), {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if not entry: continue
+                if entry[1] <= now:
+                    self._drop(key)
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry
+        return found
+
+    def set_many(self, entries: dict):
+        with self._lock:
+            for key, (value, expires_at, size) in entries.items():
+                if size > self.max_bytes: continue
+                self._drop(key)
+                self._entries[key] = (value, expires_at, size)
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._drop(key)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= entry[2]
+
+class DiskCacheBackend:
+    """SQLite (WAL) file: survives restarts, shared by the workers on one host"""
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_DISK_MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "cache.sqlite3"), timeout=5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, size INTEGER, accessed_at REAL)"
+        )
+        self._db.commit()
+
+    @property
+    def bytes(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> dict:
+        if not keys: return {}
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT key, value, expires_at, size FROM cache_entries WHERE key IN ({','.join('?' * len(keys))}) AND expires_at > ?",
+                (*keys, now),
+            ).fetchall()
+            if rows:
+                self._db.executemany("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", [(now, r[0]) for r in rows])
+                self._db.commit()
+        return {key: (json.loads(value), expires_at, size) for key, value, expires_at, size in rows}
+
+    def set_many(self, entries: dict):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires_at, size, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                [(key, json.dumps(value), expires_at, size, now) for key, (value, expires_at, size) in entries.items()],
+            )
+            self._writes += len(entries)
+            if self._writes >= CACHE_PRUNE_EVERY_WRITES:
+                self._writes = 0
+                self._prune(now)
+            self._db.commit()
+
+    def _prune(self, now: float):
+        self._db.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+        if total > self.max_bytes:
+            # Least recently used first, until we're back under ~90% of the budget
+            excess = total - int(self.max_bytes * 0.9)
+            victims, freed = [], 0
+            for key, size in self._db.execute("SELECT key, size FROM cache_entries ORDER BY accessed_at"):
+                if freed >= excess: break
+                victims.append((key,))
+                freed += size
+            self._db.executemany("DELETE FROM cache_entries WHERE key = ?", victims)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            self._db.commit()
+
+CACHE_ENTRIES_DDL = """
+create table if not exists public.cache_entries (
+    key text primary key,
+    value jsonb,  -- Nullable: negative entries (e.g. geocode misses) cache None
+    size integer not null default 0,
+    expires_at timestamptz not null
+);
+alter table public.cache_entries alter column value drop not null;
+create index if not exists cache_entries_expires_at_idx on public.cache_entries (expires_at);
+"""
+
+class SupabaseCacheBackend:
+    """`cache_entries` table (key text pk, value jsonb, size int, expires_at timestamptz)"""
+
+    def __init__(self, max_rows: int = CACHE_STORE_MAX_ROWS):
+        self.max_rows = max_rows
+        self.bytes = None  # Not tracked locally; sum(size) in SQL if you need it
+        self.disabled = False
+        self._writes = 0
+
+    def _failed(self, action: str, e: Exception):
+        """A missing table (42P01 / PGRST205) turns the backend off instead of failing every call"""
+        text = str(e)
+        if "cache_entries" in text and any(m in text for m in ("42P01", "PGRST205", "does not exist", "Could not find")):
+            self.disabled = True
+            logger.error(f"Shared cache disabled, falling back to memory: cache_entries is missing. Create it with:{CACHE_ENTRIES_DDL}")
+        else:
+            logger.error(f"Cache {action} Error: {e}")
+
+    def get_many(self, keys: List[str]) -> dict:
+        if not keys or self.disabled: return {}
+        try:
+            resp = supabase.table("cache_entries").select("key, value, size, expires_at")\
+                .in_("key", keys)\
+                .gt("expires_at", datetime.now(timezone.utc).isoformat())\
+                .execute()
+            return {
+                row["key"]: (row["value"], parse_timestamp(row["expires_at"]).timestamp(), row.get("size") or 0)
+                for row in resp.data or []
+            }
+        except Exception as e:
+            self._failed("Read", e)
+            return {}
+
+    def set_many(self, entries: dict):
+        if not entries or self.disabled: return
+        try:
+            supabase.table("cache_entries").upsert([
+                {"key": key, "value": value, "size": size,
+                 "expires_at": datetime.fromtimestamp(expires_at, timezone.utc).isoformat()}
+                for key, (value, expires_at, size) in entries.items()
+            ]).execute()
+            self._writes += len(entries)
+            if self._writes >= CACHE_PRUNE_EVERY_WRITES:
+                self._writes = 0
+                supabase.table("cache_entries").delete().lt("expires_at", datetime.now(timezone.utc).isoformat()).execute()
+                overflow = supabase.table("cache_entries").select("key")\
+                    .order("expires_at", desc=True)\
+                    .range(self.max_rows, self.max_rows + 999).execute()
+                if overflow.data:
+                    supabase.table("cache_entries").delete().in_("key", [r["key"] for r in overflow.data]).execute()
+        except Exception as e:
+            self._failed("Write", e)
+
+    def delete(self, key: str):
+        if self.disabled: return
+        try:
+            supabase.table("cache_entries").delete().eq("key", key).execute()
+        except Exception as e:
+            self._failed("Delete", e)
+
+def make_cache_backend(kind: str):
+    if kind == "disk":
+        return DiskCacheBackend()
+    if kind == "supabase":
+        return SupabaseCacheBackend()
+    return None  # "memory": L1 only
+
+memory_cache = MemoryCacheBackend()
+shared_cache = make_cache_backend(CACHE_BACKEND)
+
+class Cache:
+    """A namespace in the shared cache. Values must be JSON-serializable."""
+    registry = {}
+
+    def __init__(self, namespace: str, ttl: float, shared: bool = True):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.shared = shared
+        self.stats = {"hits": 0, "memory_hits": 0, "shared_hits": 0, "misses": 0,
+                      "sets": 0, "bytes_written": 0}
+        Cache.registry[namespace] = self
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def _backends(self):
+        return [memory_cache] + ([shared_cache] if self.shared and shared_cache else [])
+
+    def get_many(self, keys: List[str]) -> dict:
+        """key -> value for every hit (misses are simply absent)"""
+        pending = {self._key(k): k for k in keys}
+        found = {}
+        for i, backend in enumerate(self._backends()):
+            if not pending: break
+            hits = backend.get_many(list(pending))
+            for full_key, entry in hits.items():
+                found[pending.pop(full_key)] = entry[0]
+                self.stats["memory_hits" if i == 0 else "shared_hits"] += 1
+            if i > 0 and hits:
+                memory_cache.set_many(hits)  # promote to L1 with the same expiry
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(pending)
+        return found
+
+    def get(self, key: str, default=MISSING):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, values: dict, ttl: Optional[float] = None):
+        if not values: return
+        expires_at = time.time() + (ttl or self.ttl)
+        entries = {}
+        for key, value in values.items():
+            size = payload_bytes(value)
+            entries[self._key(key)] = (value, expires_at, size)
+            self.stats["sets"] += 1
+            self.stats["bytes_written"] += size
+        for backend in self._backends():
+            backend.set_many(entries)
+
+    def set(self, key: str, value, ttl: Optional[float] = None):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key: str):
+        for backend in self._backends():
+            backend.delete(self._key(key))
+
+def cache_stats() -> dict:
+    namespaces = {}
+    for name, cache in Cache.registry.items():
+        lookups = cache.stats["hits"] + cache.stats["misses"]
+        namespaces[name] = {**cache.stats, "hit_rate": round(cache.stats["hits"] / lookups, 3) if lookups else None}
+    return {
+        "backend": "memory" if getattr(shared_cache, "disabled", False) else CACHE_BACKEND,
+        "memory_bytes": memory_cache.bytes,
+        "shared_bytes": shared_cache.bytes if shared_cache else None,
+        "namespaces": namespaces,
+    }
+
+# --- UPSTREAM RECORD / REPLAY ---
+# Capacity tests without paid calls. UPSTREAM_MODE=record appends every Geocoding, Places,
+# SerpApi and Groq exchange (secrets dropped, prompts and addresses hashed, reviewer
+# profiles pseudonymized, geocodes reduced to a rounded point) with its latency to
+# UPSTREAM_TAPE, plus the inbound /api/search and /api/reviews bodies (user_id dropped,
+# address hashed, user coordinates rounded to the finest Places cache cell).
+# UPSTREAM_MODE=replay answers those calls from the tape after sleeping the recorded latency
+# (x UPSTREAM_REPLAY_LATENCY_SCALE); requests that were never recorded get a response drawn
+# from the same service, so varied or scaled-up traffic still runs. `python api/index.py
+# replay-load` pushes the recorded inbound traffic through the real handlers at
+# REPLAY_LOAD_SPEEDUP x its original rate. API keys only need to be non-empty in replay.
+# Supabase is still called: point it at staging.
+UPSTREAM_MODE = os.getenv("UPSTREAM_MODE", "live")   # live | record | replay
+UPSTREAM_TAPE = os.getenv("UPSTREAM_TAPE", "/tmp/safebites-upstream.jsonl")
+UPSTREAM_REPLAY_LATENCY_SCALE = float(os.getenv("UPSTREAM_REPLAY_LATENCY_SCALE", "1.0"))
+UPSTREAM_SECRET_FIELDS = {"key", "api_key", "X-Goog-Api-Key"}
+UPSTREAM_COORD_DECIMALS = 2   # 0.01 deg, the finest Places cache cell
+REPLAY_LOAD_SPEEDUP = float(os.getenv("REPLAY_LOAD_SPEEDUP", "1.0"))
+REPLAY_LOAD_WORKERS = int(os.getenv("REPLAY_LOAD_WORKERS", "16"))
+
+upstream_stats = {"recorded": 0, "replayed": 0, "replay_misses": 0}
+
+class UpstreamReplayError(Exception):
+    """A recorded upstream failure, raised again on replay"""
+
+def tape_hash(text: str) -> str:
+    return "sha1:" + hashlib.sha1(text.encode()).hexdigest()
+
+def sanitize_upstream_request(request: dict) -> dict:
+    """Drops credentials; chat messages (review texts, community comments) and addresses become hashes"""
+    clean = {}
+    for k, v in request.items():
+        if k in UPSTREAM_SECRET_FIELDS: continue
+        if isinstance(v, dict):
+            v = sanitize_upstream_request(v)
+        elif k == "address" and isinstance(v, str):
+            v = tape_hash(v)
+        elif k == "messages":
+            v = [{"role": m["role"], "sha1": hashlib.sha1(m["content"].encode()).hexdigest(),
+                  "chars": len(m["content"])} for m in v]
+        clean[k] = v
+    return clean
+
+def sanitize_upstream_response(service: str, response):
+    """Keeps only what replay reads where a response can identify a user: the rounded point of a
+    geocode (the address may be someone's home) and a stable pseudonym for each SerpApi reviewer"""
+    if not isinstance(response, dict): return response
+    if service == "geocode":
+        results = []
+        for r in (response.get("results") or [])[:1]:
+            loc = r["geometry"]["location"]
+            results.append({"geometry": {"location": {"lat": round(loc["lat"], UPSTREAM_COORD_DECIMALS),
+                                                      "lng": round(loc["lng"], UPSTREAM_COORD_DECIMALS)}}})
+        return {"status": response.get("status"), "results": results}
+    if service == "serpapi" and response.get("reviews"):
+        reviews = []
+        for r in response["reviews"]:
+            name = (r.get("user") or {}).get("name") or "Anonymous"
+            reviews.append({**r, "user": {"name": "reviewer-" + tape_hash(name)[5:15]}})
+        return {**response, "reviews": reviews}
+    return response
+
+def upstream_key(service: str, request: dict) -> str:
+    return hashlib.sha1(json.dumps([service, sanitize_upstream_request(request)], sort_keys=True, default=str).encode()).hexdigest()
+
+class UpstreamTape:
+    def __init__(self, path: str):
+        self.path = path
+        self.by_key = {}        # (service, key) -> [entries]
+        self.by_service = {}    # service -> [entries]
+        self.inbound = []       # recorded /api/search and /api/reviews bodies, oldest first
+        self.loaded = False
+        self._next = {}         # round-robin position per (service, key)
+        self._lock = threading.Lock()
+
+    def append(self, entry: dict):
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def load(self):
+        with self._lock:
+            if self.loaded: return
+            with open(self.path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry["service"] == "inbound":
+                        self.inbound.append(entry)
+                        continue
+                    self.by_key.setdefault((entry["service"], entry["key"]), []).append(entry)
+                    self.by_service.setdefault(entry["service"], []).append(entry)
+            self.loaded = True
+        logger.info(f"Upstream tape loaded: {sum(map(len, self.by_service.values()))} exchanges, "
+                    f"{len(self.inbound)} inbound requests from {self.path}")
+
+    def lookup(self, service: str, key: str) -> dict:
+        self.load()
+        with self._lock:
+            entries = self.by_key.get((service, key))
+            if entries:
+                i = self._next.get((service, key), 0)
+                self._next[(service, key)] = i + 1
+                upstream_stats["replayed"] += 1
+                return entries[i % len(entries)]
+            upstream_stats["replay_misses"] += 1
+        pool = self.by_service.get(service)
+        if not pool:
+            raise UpstreamReplayError(f"No recorded {service} exchanges in {self.path}")
+        return random.choice(pool)
+
+upstream_tape = UpstreamTape(UPSTREAM_TAPE)
+
+def _record(service: str, request: dict, started: float, **outcome):
+    upstream_tape.append({
+        "service": service,
+        "key": upstream_key(service, request),
+        "request": sanitize_upstream_request(request),
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        **outcome,
+    })
+    upstream_stats["recorded"] += 1
+
+def upstream_call(service: str, request: dict, call):
+    """Runs call() (live), records it (record) or serves it from the tape (replay). call() must return JSON-able data."""
+    if UPSTREAM_MODE == "replay":
+        entry = upstream_tape.lookup(service, upstream_key(service, request))
+        time.sleep(entry["latency_ms"] / 1000 * UPSTREAM_REPLAY_LATENCY_SCALE)
+        if "error" in entry:
+            raise UpstreamReplayError(entry["error"])
+        return entry["response"]
+    if UPSTREAM_MODE != "record":
+        return call()
+
+    started = time.perf_counter()
+    try:
+        response = call()
+    except Exception as e:
+        _record(service, request, started, error=str(e))
+        raise
+    _record(service, request, started, response=sanitize_upstream_response(service, response))
+    return response
+
+def upstream_stream(service: str, request: dict, call):
+    """upstream_call for an iterator of text chunks; replay keeps the recorded chunk timing"""
+    if UPSTREAM_MODE == "replay":
+        entry = upstream_tape.lookup(service, upstream_key(service, request))
+        elapsed = 0.0
+        for offset_ms, chunk in entry.get("chunks", []):
+            time.sleep(max(0.0, offset_ms - elapsed) / 1000 * UPSTREAM_REPLAY_LATENCY_SCALE)
+            elapsed = offset_ms
+            yield chunk
+        if "error" in entry:
+            raise UpstreamReplayError(entry["error"])
+        return
+    if UPSTREAM_MODE != "record":
+        yield from call()
+        return
+
+    started = time.perf_counter()
+    chunks = []
+    try:
+        for chunk in call():
+            chunks.append((round((time.perf_counter() - started) * 1000, 1), chunk))
+            yield chunk
+    except Exception as e:
+        _record(service, request, started, chunks=chunks, error=str(e))
+        raise
+    _record(service, request, started, chunks=chunks)
+
+def record_inbound(endpoint: str, body: BaseModel):
+    """Replayed searches by a hashed address miss the geocode tape and get a recorded point instead"""
+    if UPSTREAM_MODE != "record": return
+    clean = body.model_dump(exclude={"user_id"})
+    if endpoint == "search":
+        if clean.get("address"):
+            clean["address"] = tape_hash(clean["address"])
+        for k in ("user_lat", "user_lon"):
+            if clean.get(k) is not None:
+                clean[k] = round(clean[k], UPSTREAM_COORD_DECIMALS)
+    upstream_tape.append({
+        "service": "inbound",
+        "endpoint": endpoint,
+        "at": time.time(),
+        "body": clean,
+    })
+
+def replay_load():
+    """Recorded inbound traffic through the real handlers, upstreams from the tape (python api/index.py replay-load)"""
+    global UPSTREAM_MODE
+    UPSTREAM_MODE = "replay"
+    upstream_tape.load()
+    inbound = upstream_tape.inbound
+    if not inbound:
+        print(f"No inbound requests recorded in {UPSTREAM_TAPE}")
+        return
+
+    def run(entry):
+        started = time.perf_counter()
+        try:
+            if entry["endpoint"] == "search":
+                handle_search(SearchRequest(**entry["body"]), Response(), None)
+            else:
+                handle_reviews(ReviewRequest(**entry["body"]))
+            ok = True
+        except Exception as e:
+            logger.error(f"Replay {entry['endpoint']} Error: {e}")
+            ok = False
+        return entry["endpoint"], ok, (time.perf_counter() - started) * 1000
+
+    first_at = inbound[0]["at"]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=REPLAY_LOAD_WORKERS) as pool:
+        futures = []
+        for entry in inbound:
+            # Same arrival pattern as recorded, compressed REPLAY_LOAD_SPEEDUP times
+            delay = (entry["at"] - first_at) / REPLAY_LOAD_SPEEDUP - (time.perf_counter() - start)
+            if delay > 0: time.sleep(delay)
+            futures.append(pool.submit(run, entry))
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start
+
+    recorded_span = max(inbound[-1]["at"] - first_at, 1e-9)
+    print(f"{len(results)} requests in {elapsed:.1f}s = {len(results) / elapsed:.1f} req/s "
+          f"(recorded {len(inbound) / recorded_span:.2f} req/s, speedup {REPLAY_LOAD_SPEEDUP}x, {REPLAY_LOAD_WORKERS} workers)")
+    for endpoint in sorted({r[0] for r in results}):
+        latencies = sorted(ms for name, ok, ms in results if name == endpoint)
+        errors = sum(1 for name, ok, _ in results if name == endpoint and not ok)
+        pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+        print(f"  {endpoint:8} n={len(latencies):5}  p50={pct(0.5):7.1f}ms  p95={pct(0.95):7.1f}ms  "
+              f"p99={pct(0.99):7.1f}ms  errors={errors}")
+    print(f"  upstream: {upstream_stats}")
+
+# --- GEOCODING ---
+# Canonical address key -> shared cache ("geocode" namespace) -> Google.
+# "Not found" answers are cached too, but briefly; transport / quota errors never are.
+GEOCODE_TIMEOUT_SECONDS = 5
+GEOCODE_TTL_SECONDS = 90 * 86400
+GEOCODE_NEGATIVE_TTL_SECONDS = 3600
+GEOCODE_BULK_WORKERS = 4
+
+ADDRESS_ABBREVIATIONS = {
+    "street": "st", "avenue": "ave", "road": "rd", "boulevard": "blvd", "drive": "dr",
+    "lane": "ln", "court": "ct", "place": "pl", "parkway": "pkwy", "highway": "hwy",
+    "suite": "ste", "north": "n", "south": "s", "east": "e", "west": "w",
+    "northeast": "ne", "northwest": "nw", "southeast": "se", "southwest": "sw",
+}
+
+def canonicalize_address(address: Optional[str]) -> str:
+    """'Atlanta, GA ', 'atlanta ga' and 'ATLANTA,  GA, USA' -> 'atlanta ga'"""
+    text = unicodedata.normalize("NFKC", address or "").lower()
+    text = re.sub(r"[^\w\s#-]", " ", text)
+    words = [ADDRESS_ABBREVIATIONS.get(w, w) for w in text.split()]
+    while words and words[-1] in ("usa", "us"):
+        words.pop()
+    if words[-2:] == ["united", "states"]:
+        words = words[:-2]
+    return " ".join(words)
+
+geocode_cache = Cache("geocode", GEOCODE_TTL_SECONDS)
+geocode_stats = {"lookups": 0, "negative_hits": 0, "api_calls": 0, "api_errors": 0}
+
+def _geocode_api(address: str):
+    """('ok', (lat, lng)) | ('not_found', None) | ('error', None)"""
+    if not GOOGLE_KEY: return "error", None
     url = "https://maps.googleapis.com/maps/api/geocode/json"
     params = {"address": address, "key": GOOGLE_KEY}
-    resp = requests.get(url, params=params).json()
+    geocode_stats["api_calls"] += 1
+    try:
+        resp = upstream_call("geocode", params,
+                             lambda: requests.get(url, params=params, timeout=GEOCODE_TIMEOUT_SECONDS).json())
+    except Exception as e:
+        geocode_stats["api_errors"] += 1
+        logger.error(f"Geocoding Error: {e}")
+        return "error", None
     if resp.get("results"):
         loc = resp["results"][0]["geometry"]["location"]
-        return loc["lat"], loc["lng"]
-    return None, None
+        return "ok", (loc["lat"], loc["lng"])
+    if resp.get("status") == "ZERO_RESULTS":
+        return "not_found", None
+    geocode_stats["api_errors"] += 1
+    logger.error(f"Geocoding Error: {resp.get('status')} {resp.get('error_message', '')}")
+    return "error", None
 
+def _geocode_result(cached):
+    """Cached value -> (lat, lng); None is a cached 'not found'"""
+    if cached is None:
+        geocode_stats["negative_hits"] += 1
+        return None, None
+    return tuple(cached)
 
-def analyze_reviews_with_ai(reviews: List[dict]):
+# Function to convert address to lat/lon using Google Geocoding API
+def geocode_address(address: str):
+    """Converts a string address to lat/lon"""
+    key = canonicalize_address(address)
+    if not key: return None, None
+    geocode_stats["lookups"] += 1
+
+    cached = geocode_cache.get(key)
+    if cached is not MISSING:
+        return _geocode_result(cached)
+
+    status, coords = _geocode_api(address)
+    if status == "error":
+        return None, None
+    geocode_cache.set(key, list(coords) if coords else None,
+                      GEOCODE_TTL_SECONDS if coords else GEOCODE_NEGATIVE_TTL_SECONDS)
+    return coords or (None, None)
+
+def geocode_many(addresses: List[str]) -> dict:
     """
-    Sends reviews to Groq (llama-3.3-70b-versatile) to generate a weighted safety score and summary.
+    Bulk variant for offline jobs: one cache read for every address, parallel API calls
+    for the misses, one cache write. Returns address -> (lat, lng) (or (None, None)).
     """
-    if not reviews:
-        return 0, "No reviews available to analyze."
-    
-    # 1. Define keywords that matter
-    keywords = ["gluten", "celiac", "cross-contamination", "dedicated fryer", "coeliac", "dedicated"]
+    keys = {a: canonicalize_address(a) for a in addresses if a}
+    unique = {}
+    for a, k in keys.items():
+        if k: unique.setdefault(k, a)
+    geocode_stats["lookups"] += len(unique)
+
+    results = {k: _geocode_result(v) for k, v in geocode_cache.get_many(list(unique)).items()}
+    pending = {k: a for k, a in unique.items() if k not in results}
+
+    found, not_found = {}, {}
+    with ThreadPoolExecutor(max_workers=GEOCODE_BULK_WORKERS) as pool:
+        for key, (status, coords) in zip(pending, pool.map(_geocode_api, pending.values())):
+            if status == "error": continue
+            results[key] = coords or (None, None)
+            if coords:
+                found[key] = list(coords)
+            else:
+                not_found[key] = None
+    geocode_cache.set_many(found)
+    geocode_cache.set_many(not_found, GEOCODE_NEGATIVE_TTL_SECONDS)
+
+    return {a: results.get(k) or (None, None) for a, k in keys.items()}
+
+def geocode_hit_rates() -> dict:
+    lookups = geocode_stats["lookups"] or 1
+    return {
+        **geocode_stats,
+        "memory_hits": geocode_cache.stats["memory_hits"],
+        "shared_hits": geocode_cache.stats["shared_hits"],
+        "hit_rate": round(geocode_cache.stats["hits"] / lookups, 3),
+        "negative_hit_rate": round(geocode_stats["negative_hits"] / lookups, 3),
+    }
+
+def backfill_restaurant_coords():
+    """Offline job: geocode restaurants rows that are missing lat/lng (python api/index.py backfill-coords)"""
+    rows = [r for r in iter_restaurant_rows("place_id, address, lat, lng") if r.get("lat") is None and r.get("address")]
+    coords = geocode_many([r["address"] for r in rows])
+    updated = 0
+    for r in rows:
+        lat, lng = coords.get(r["address"], (None, None))
+        if lat is None: continue
+        try:
+            supabase.table("restaurants").update({"lat": lat, "lng": lng}).eq("place_id", r["place_id"]).execute()
+            updated += 1
+        except Exception as e:
+            logger.error(f"Backfill Error for {r['place_id']}: {e}")
+    print(f"Geocoded {updated}/{len(rows)} restaurants. {geocode_hit_rates()}")
+
+# --- RELEVANCE ENGINE ---
+# Term -> weight. Compiled once at import; phrases tolerate spaces OR hyphens
+# ("cross contamination" == "cross-contamination") and match on word boundaries
+# so "dedicated" doesn't fire inside "undedicated" and "gluten" doesn't fire inside "glutenous".
+RELEVANCE_TERMS = {
+    "celiac": 3.0,
+    "coeliac": 3.0,
+    "gluten free": 2.0,
+    "gluten": 1.5,
+    "glutened": 4.0,
+    "cross contamination": 3.0,
+    "cross contact": 3.0,
+    "dedicated fryer": 4.0,
+    "dedicated kitchen": 4.0,
+    "dedicated": 1.0,
+    "gf menu": 2.0,
+    "gf": 1.0,
+    "got sick": 3.0,
+}
+
+# Words that flip the meaning of the term right after them ("not dedicated", "no dedicated fryer").
+# Negated mentions are still relevant (they're often the most important safety signal),
+# they're just reported separately so nobody reads "not dedicated" as a dedicated tag.
+NEGATION_CUES = ["not", "no", "isn't", "isnt", "wasn't", "wasnt", "aren't", "arent",
+                 "don't", "dont", "doesn't", "doesnt", "never", "without", "non"]
+
+# Words allowed between a cue and its term ("do not have a dedicated fryer")
+NEGATION_FILLERS = ["a", "an", "the", "have", "has", "had", "use", "uses", "offer", "offers",
+                    "really", "fully", "truly", "100%"]
+
+def _phrase_pattern(term: str) -> str:
+    return r"[\s\-]+".join(re.escape(w) for w in term.split())
+
+# Longest terms first so "dedicated fryer" wins over "dedicated" in the alternation
+_RELEVANCE_TERM_PATTERNS = {
+    term: _phrase_pattern(term) for term in sorted(RELEVANCE_TERMS, key=len, reverse=True)
+}
+RELEVANCE_REGEX = re.compile(
+    r"\b(?:(?P<neg>" + "|".join(re.escape(c) for c in NEGATION_CUES) + r")[\s\-]+(?:(?:" + "|".join(re.escape(f) for f in NEGATION_FILLERS) + r")\s+){0,2})?"
+    r"(?P<term>" + "|".join(_RELEVANCE_TERM_PATTERNS.values()) + r")\b",
+    re.IGNORECASE,
+)
+_RELEVANCE_TERM_MATCHERS = [(term, re.compile(pat + r"$", re.IGNORECASE)) for term, pat in _RELEVANCE_TERM_PATTERNS.items()]
+
+COMMUNITY_TAG_REGEX = re.compile(r"^(\s*\[[^\]]*\])+\s*")   # "[SAFE REPORT] [DEDICATED GF] ..."
+
+def _canonical_term(matched: str) -> str:
+    for term, matcher in _RELEVANCE_TERM_MATCHERS:
+        if matcher.match(matched):
+            return term
+    return matched.lower()
+
+def score_review_relevance(text: str) -> dict:
+    """Single pass over the text -> {'relevance_score', 'matched_terms', 'negated_terms'}"""
+    matched, negated = [], []
+    score = 0.0
+    # Our own community badges aren't the reviewer's words; curly apostrophes ("isn’t") are
+    text = COMMUNITY_TAG_REGEX.sub("", (text or "").replace("\u2019", "'"))
+    for m in RELEVANCE_REGEX.finditer(text):
+        term = _canonical_term(m.group("term"))
+        if m.group("neg"):
+            label = f"not {term}"
+            if label not in negated:
+                negated.append(label)
+                score += RELEVANCE_TERMS.get(term, 1.0)
+        elif term not in matched:
+            matched.append(term)
+            score += RELEVANCE_TERMS.get(term, 1.0)
+    return {
+        "relevance_score": round(score, 1),
+        "matched_terms": matched,
+        "negated_terms": negated,
+    }
+
+def annotate_relevance(review: dict) -> dict:
+    """Stores the relevance fields on the review dict (once). Called at ingestion time."""
+    if "relevance_score" not in review:
+        review.update(score_review_relevance(review.get("text", "")))
+    return review
+
+
+GROQ_MODEL = "llama-3.3-70b-versatile"
+GROQ_CACHE_TTL_SECONDS = 30 * 86400  # Same horizon as the restaurants freshness window
+groq_cache = Cache("groq", GROQ_CACHE_TTL_SECONDS)
+AI_UNAVAILABLE_SUMMARY = "AI Analysis currently unavailable."
+
+def build_analysis_prompt(reviews: List[dict]):
+    """(system_prompt, user_content, cache key) for a non-empty list of reviews"""
+    # 1. Relevance is computed at ingestion (annotate_relevance); older cached rows get it here once
+    for r in reviews:
+        annotate_relevance(r)
 
     # 2. Helper function to determine sort weight (Higher = more important)
     def get_review_weight(r):
         weight = 0
         source = r.get("source", "Google")
         is_premium = r.get("is_premium", False)  # Check for premium flag
-        text = r.get('text', '').lower()
+        relevance = r.get("relevance_score", 0)
 
         # Tier 1: Source Hierarchy
         if is_premium:
@@ -124,9 +942,9 @@ def analyze_reviews_with_ai(reviews: List[dict]):
         else:
             weight += 100
             
-        # Tier 2: Keyword Relevance
-        if any(k in text for k in keywords):
-            weight += 10
+        # Tier 2: Keyword Relevance (stronger matches rank higher inside a tier)
+        if relevance > 0:
+            weight += 10 + min(relevance, 89)
             
         return weight
 
@@ -203,23 +1021,143 @@ def analyze_reviews_with_ai(reviews: List[dict]):
         "Return valid JSON with keys: 'score' (float) and 'summary' (string)."
     )
 
+    user_content = f"{stats_context}\n\nREVIEWS:\n{reviews_payload}"
+    # temperature=0: the same prompt gets the same answer, so identical inputs are served from cache
+    prompt_key = hashlib.sha1(f"{GROQ_MODEL}|{system_prompt}|{user_content}".encode()).hexdigest()
+    return system_prompt, user_content, prompt_key
+
+def analyze_reviews_with_ai(reviews: List[dict]):
+    """
+    Sends reviews to Groq (llama-3.3-70b-versatile) to generate a weighted safety score and summary.
+    The score is None when Groq fails or returns unparseable JSON: that result must not be stored.
+    """
+    if not reviews:
+        return 0, "No reviews available to analyze."
+
+    system_prompt, user_content, prompt_key = build_analysis_prompt(reviews)
+    cached = groq_cache.get(prompt_key)
+    if cached is not MISSING:
+        return cached["score"], cached["summary"]
+
     try:
-        completion = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile", 
-            messages=[
+        request = {
+            "model": GROQ_MODEL,
+            "messages": [
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"{stats_context}\n\nREVIEWS:\n{reviews_payload}"}
+                {"role": "user", "content": user_content}
             ],
-            temperature=0, 
-            response_format={"type": "json_object"} 
-        )
+            "temperature": 0,
+            "response_format": {"type": "json_object"},
+        }
+        content = upstream_call("groq", request,
+                                lambda: groq_client.chat.completions.create(**request).choices[0].message.content)
         
-        result = json.loads(completion.choices[0].message.content)
-        return result.get("score", 5), result.get("summary", "Analysis failed.")
+        result = json.loads(content)
+        score, summary = result.get("score", 5), result.get("summary", "Analysis failed.")
+        groq_cache.set(prompt_key, {"score": score, "summary": summary})
+        return score, summary
 
     except Exception as e:
         logger.error(f"Groq AI Error: {e}")
-        return 0, "AI Analysis currently unavailable."
+        return None, AI_UNAVAILABLE_SUMMARY
+
+# --- STREAMED ANALYSIS ---
+JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class JsonStringStreamer:
+    """Decodes one string value out of a JSON object while the object is still streaming in"""
+    def __init__(self, key: str):
+        self._key = re.compile(r'"%s"\s*:\s*"' % re.escape(key))
+        self._buf = ""
+        self._started = False
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """Returns the newly decoded part of the value (may be empty)"""
+        if self.done: return ""
+        self._buf += chunk
+        if not self._started:
+            m = self._key.search(self._buf)
+            if not m: return ""
+            self._started = True
+            self._buf = self._buf[m.end():]
+
+        buf, out, i = self._buf, [], 0
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            # Escapes may be split across chunks: wait until the whole sequence is here
+            if i + 1 >= len(buf): break
+            if buf[i + 1] != "u":
+                out.append(JSON_ESCAPES.get(buf[i + 1], buf[i + 1]))
+                i += 2
+                continue
+            width = 6
+            if i + 6 <= len(buf) and 0xD800 <= int(buf[i + 2:i + 6], 16) < 0xDC00:
+                width = 12  # Surrogate pair
+            if i + width > len(buf): break
+            out.append(json.loads(f'"{buf[i:i + width]}"'))
+            i += width
+        self._buf = buf[i:]
+        return "".join(out)
+
+def stream_review_analysis(reviews: List[dict]):
+    """
+    Streaming twin of analyze_reviews_with_ai: yields ("summary", {"text": delta}) events as
+    Groq generates, returns (score, summary) like the blocking version (same cache entries).
+    """
+    if not reviews:
+        summary = "No reviews available to analyze."
+        yield "summary", {"text": summary}
+        return 0, summary
+
+    system_prompt, user_content, prompt_key = build_analysis_prompt(reviews)
+    cached = groq_cache.get(prompt_key)
+    if cached is not MISSING:
+        yield "summary", {"text": cached["summary"]}
+        return cached["score"], cached["summary"]
+
+    try:
+        # JSON mode streams the raw object; the summary is decoded out of it as it arrives
+        # and the whole object is parsed once it is complete
+        request = {
+            "model": GROQ_MODEL,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content}
+            ],
+            "temperature": 0,
+            "response_format": {"type": "json_object"},
+            "stream": True,
+        }
+
+        def deltas():
+            for chunk in groq_client.chat.completions.create(**request):
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta: yield delta
+
+        summary_stream = JsonStringStreamer("summary")
+        content = []
+        for delta in upstream_stream("groq_stream", request, deltas):
+            content.append(delta)
+            text = summary_stream.feed(delta)
+            if text:
+                yield "summary", {"text": text}
+
+        result = json.loads("".join(content))
+        score, summary = result.get("score", 5), result.get("summary", "Analysis failed.")
+        groq_cache.set(prompt_key, {"score": score, "summary": summary})
+        return score, summary
+
+    except Exception as e:
+        logger.error(f"Groq AI Stream Error: {e}")
+        return None, AI_UNAVAILABLE_SUMMARY
     
 
 def calculate_wisebites_score(
@@ -305,64 +1243,697 @@ def calculate_wisebites_score(
 
     return round(final_score, 1)
 
-@lru_cache(maxsize=100) 
-def fetch_google_search(query: str, location: str, lat: float = None, lng: float = None):
+# --- BULK SCORE RECOMPUTE ---
+# After a weight change in calculate_wisebites_score, `python api/index.py recompute-scores`
+# re-scores every stored row from its stored inputs (no SerpApi / Groq): community aggregates
+# are tallied in one pass over user_reviews, restaurants are streamed in chunks and scored as
+# whole columns, and only rows whose score moved are upserted. `score-parity` checks the
+# column scorer against the scalar function, element for element.
+SCORE_RECOMPUTE_CHUNK = 1000
+SCORE_RECOMPUTE_COLUMNS = "place_id, name, ai_safety_score, average_safety_rating, relevant_count, wise_bites_score, last_updated"
+COMMUNITY_SCORE_COLUMNS = "id, place_id, rating, did_feel_safe, is_dedicated_gluten_free, profiles(is_premium)"
+NO_COMMUNITY_REVIEWS = (0, 0, 0, 0, 0, 0)
+
+def tally_community_reviews(rows: List[dict]):
+    """user_reviews rows (with profiles.is_premium) -> (avg, safe_free, safe_prem, dedicated, unsafe_free, unsafe_prem)"""
+    wb_avg = 0
+    wb_ratings = [r['rating'] for r in rows if r.get('rating')]
+    if wb_ratings:
+        wb_avg = sum(wb_ratings) / len(wb_ratings)
+
+    safe_free = safe_prem = dedicated = unsafe_free = unsafe_prem = 0
+    for r in rows:
+        is_premium = (r.get('profiles') or {}).get('is_premium', False)
+        if r.get('is_dedicated_gluten_free', False):
+            dedicated += 1
+        if r.get('did_feel_safe') is True:
+            if is_premium: safe_prem += 1
+            else: safe_free += 1
+        elif r.get('did_feel_safe') is False:
+            if is_premium: unsafe_prem += 1
+            else: unsafe_free += 1
+    return wb_avg, safe_free, safe_prem, dedicated, unsafe_free, unsafe_prem
+
+def load_community_aggregates(page_size: int = SCORE_RECOMPUTE_CHUNK) -> dict:
+    """
+    place_id -> tally_community_reviews(...) for every place with community reviews.
+    Keyset-paged on the unique id: offsets over a non-unique order repeat or skip rows at page
+    boundaries, and reviews inserted mid-scan would shift every later page.
+    """
+    by_place, last_id = {}, None
+    while True:
+        q = supabase.table("user_reviews").select(COMMUNITY_SCORE_COLUMNS)
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        resp = q.order("id").limit(page_size).execute()
+        rows = resp.data or []
+        for r in rows:
+            by_place.setdefault(r["place_id"], []).append(r)
+        if len(rows) < page_size: break
+        last_id = rows[-1]["id"]
+    return {pid: tally_community_reviews(rows) for pid, rows in by_place.items()}
+
+def score_batch(ai_scores, safety_ratings, google_counts, wb_avgs,
+                safe_free, safe_prem, dedicated, unsafe_free, unsafe_prem) -> List[Optional[float]]:
+    """calculate_wisebites_score over whole columns (same argument order, one list per argument)"""
+    if np is None or len(ai_scores) < NUMPY_MIN_BATCH:
+        return [calculate_wisebites_score(*args) for args in zip(
+            ai_scores, safety_ratings, google_counts, wb_avgs,
+            safe_free, safe_prem, dedicated, unsafe_free, unsafe_prem)]
+
+    # Same None handling and the same float64 operations, in the same order, as the scalar path
+    ai, safety, wb_avg = (np.nan_to_num(np.array(c, dtype=float), nan=0.0)  # None -> NaN -> 0.0
+                          for c in (ai_scores, safety_ratings, wb_avgs))
+    google = np.nan_to_num(np.array(google_counts, dtype=float), nan=0.0).astype(np.int64)  # int() truncation
+    sf, sp, dd, uf, up = (np.asarray(c, dtype=np.int64) for c in (safe_free, safe_prem, dedicated, unsafe_free, unsafe_prem))
+
+    verified = (sf + sp + uf + up) > 0
+    verified_score = ((ai * 7) + (wb_avg * 6) + ((sf * 2) + (sp * 5) + (dd * 5)) - ((uf * 15) + (up * 25))) / 10.0
+    cold_score = ((ai * 8) + np.where(google > 3, safety * 4, safety * 2)) / 10.0
+    final = np.clip(np.where(verified, verified_score, cold_score), 1.0, 10.0)
+    no_data = ~verified & (google == 0)
+
+    # rint(x * 10) / 10 is the same double as round(x, 1) whenever both pick the same tenth; they
+    # can only disagree next to a .x5 tie, so those few go through Python's correctly-rounded round()
+    scaled = final * 10
+    rounded = np.rint(scaled) / 10
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(near_tie).tolist():
+        rounded[i] = round(final[i].item(), 1)
+    rounded = rounded.astype(object)
+    rounded[no_data] = None
+    return rounded.tolist()
+
+def score_rows(rows: List[dict], aggregates: dict) -> List[Optional[float]]:
+    community = [aggregates.get(r["place_id"], NO_COMMUNITY_REVIEWS) for r in rows]
+    columns = list(zip(*community)) if community else [[]] * 6
+    return score_batch(
+        [r.get("ai_safety_score") for r in rows],
+        [r.get("average_safety_rating") for r in rows],
+        [r.get("relevant_count") for r in rows],
+        *columns,
+    )
+
+def _score_changed(old, new) -> bool:
+    if old is None or new is None:
+        return old is not new
+    return abs(float(old) - new) > 1e-9
+
+def recompute_scores(chunk_size: int = SCORE_RECOMPUTE_CHUNK):
+    """Offline job: re-score every restaurant, writing back only changed rows (python api/index.py recompute-scores)"""
+    start = time.perf_counter()
+    aggregates = load_community_aggregates()
+    seen = changed = failed = 0
+
+    def flush(chunk):
+        nonlocal changed, failed
+        scores = score_rows(chunk, aggregates)
+        updates = [{"place_id": r["place_id"], "name": r.get("name"), "wise_bites_score": score}
+                   for r, score in zip(chunk, scores) if _score_changed(r.get("wise_bites_score"), score)]
+        if not updates: return
+        try:
+            # last_updated is left alone: scores moved, the underlying analysis didn't
+            supabase.table("restaurants").upsert(updates).execute()
+            changed += len(updates)
+        except Exception as e:
+            failed += len(updates)
+            logger.error(f"Score Recompute Write Error: {e}")
+
+    chunk = []
+    for row in iter_restaurant_rows(SCORE_RECOMPUTE_COLUMNS, page_size=chunk_size):
+        chunk.append(row)
+        seen += 1
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+
+    print(f"Re-scored {seen} restaurants ({len(aggregates)} with community reviews): "
+          f"{changed} updated, {failed} failed, {time.perf_counter() - start:.1f}s")
+
+def score_parity(n: int = 100000):
+    """score_batch vs calculate_wisebites_score on random and edge-case inputs (python api/index.py score-parity)"""
+    rng = random.Random(7)
+    optional = lambda v: None if rng.random() < 0.05 else v
+    cols = [[] for _ in range(9)]
+    for _ in range(n):
+        row = (
+            optional(round(rng.uniform(0, 10), rng.choice([0, 1, 2]))),
+            optional(round(rng.uniform(0, 5), 1)),
+            optional(rng.choice([0, 0, 1, 2, 3, 4, 5, 20, 50])),
+            rng.choice([0, 0, 1, 2.5, 3, 4, 13 / 3, 5]),
+            *(rng.choice([0, 0, 0, 1, 2, 3]) for _ in range(5)),
+        )
+        for col, value in zip(cols, row):
+            col.append(value)
+
+    started = time.perf_counter()
+    scalar = [calculate_wisebites_score(*args) for args in zip(*cols)]
+    scalar_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    batched = score_batch(*cols)
+    batch_ms = (time.perf_counter() - started) * 1000
+
+    mismatches = [i for i, (a, b) in enumerate(zip(scalar, batched)) if a != b]
+    print(f"n={n}  scalar {scalar_ms:.1f} ms  batched {batch_ms:.1f} ms  "
+          f"({'numpy' if np is not None else 'pure python'}), {len(mismatches)} mismatches")
+    for i in mismatches[:10]:
+        print("  ", [c[i] for c in cols], scalar[i], batched[i])
+    if mismatches:
+        sys.exit(1)
+
+# --- OPENING HOURS ---
+# weekdayDescriptions ("Monday: 11:00 AM – 2:00 PM, 5:00 – 10:00 PM") are parsed once, when a
+# place enters the Places cache or is written to `restaurants`, into sorted non-overlapping
+# [start, end) minute-of-week intervals (Monday 00:00 = 0). Overnight spans run into the next
+# day; the Sunday -> Monday wrap is split in two. "Open at" is then one bisect over a handful
+# of intervals in the place's local time. Places store an IANA time_zone (from Places'
+# timeZone), not an offset: a stored offset goes stale at every DST change. Without one we
+# fall back to the caller's current offset, and without that the answer is unknown (None).
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+WEEKDAY_INDEX = {name: i for i, name in enumerate(
+    ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"])}
+HOURS_CLOCK_REGEX = re.compile(r"^(\d{1,2})(?::(\d{2}))?\s*([ap])?\.?\s*m?\.?$", re.IGNORECASE)
+
+def _clean_hours_text(text: str) -> str:
+    for ch in ("\u2009", "\u202f", "\xa0"):
+        text = text.replace(ch, " ")
+    for dash in ("\u2013", "\u2014"):
+        text = text.replace(dash, "-")
+    return " ".join(text.split())
+
+def _parse_clock(text: str):
+    """'5:30 PM' -> (17 * 60 + 30, 'p'); meridiem is None for 24h clocks"""
+    m = HOURS_CLOCK_REGEX.match(text.strip())
+    if not m: return None
+    hour, minute = int(m.group(1)), int(m.group(2) or 0)
+    meridiem = (m.group(3) or "").lower() or None
+    if hour > 24 or minute > 59: return None
+    return hour * 60 + minute, meridiem
+
+def _apply_meridiem(minutes: int, meridiem: Optional[str]) -> int:
+    if meridiem is None: return minutes
+    hour, minute = divmod(minutes, 60)
+    return (hour % 12 + (12 if meridiem == "p" else 0)) * 60 + minute
+
+def _parse_day_ranges(body: str):
+    """Day-relative [start, end) minutes for one day's text; end may pass midnight"""
+    lowered = body.lower()
+    if lowered == "closed": return []
+    if "24 hours" in lowered: return [[0, MINUTES_PER_DAY]]
+
+    ranges = []
+    for part in body.split(","):
+        ends = part.split("-")
+        if len(ends) != 2: return None
+        start, end = _parse_clock(ends[0]), _parse_clock(ends[1])
+        if not start or not end: return None
+        # "5:00 - 10:00 PM": the start inherits the end's AM/PM
+        start_min = _apply_meridiem(start[0], start[1] or end[1])
+        end_min = _apply_meridiem(end[0], end[1])
+        if end_min == 0: end_min = MINUTES_PER_DAY
+        if end_min <= start_min: end_min += MINUTES_PER_DAY  # Overnight
+        ranges.append([start_min, end_min])
+    return ranges
+
+def parse_hours_schedule(lines: Optional[List[str]]) -> Optional[List[List[int]]]:
+    """weekdayDescriptions -> minute-of-week intervals. None = unknown (missing or unparseable)."""
+    if not lines: return None
+    raw, days_seen = [], 0
+    for line in lines:
+        day, sep, body = _clean_hours_text(line or "").partition(":")
+        day_idx = WEEKDAY_INDEX.get(day.strip().lower())
+        if not sep or day_idx is None: return None
+        ranges = _parse_day_ranges(body.strip())
+        if ranges is None: return None
+        days_seen += 1
+        offset = day_idx * MINUTES_PER_DAY
+        for start, end in ranges:
+            start, end = offset + start, offset + end
+            if end > MINUTES_PER_WEEK:  # Sunday night into Monday morning
+                raw.append([0, end - MINUTES_PER_WEEK])
+                end = MINUTES_PER_WEEK
+            raw.append([start, end])
+    if not days_seen: return None
+
+    merged = []
+    for start, end in sorted(raw):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def minute_of_week(when: datetime) -> int:
+    return when.weekday() * MINUTES_PER_DAY + when.hour * 60 + when.minute
+
+def place_minute_of_week(when_utc: datetime, time_zone: Optional[str],
+                         fallback_offset_minutes: Optional[int] = None) -> Optional[int]:
+    """Minute of week on the place's wall clock; None when its local time can't be known"""
+    if time_zone:
+        try:
+            return minute_of_week(when_utc.astimezone(ZoneInfo(time_zone)))
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    if fallback_offset_minutes is None: return None
+    return minute_of_week(when_utc + timedelta(minutes=fallback_offset_minutes))
+
+def hours_open_at(intervals: Optional[List[List[int]]], minute: Optional[int]) -> Optional[bool]:
+    """True/False for known hours, None when the place's hours (or local time) are unknown"""
+    if intervals is None or minute is None: return None
+    i = bisect.bisect_right(intervals, [minute, MINUTES_PER_WEEK + 1]) - 1
+    return i >= 0 and minute < intervals[i][1]
+
+def parse_open_at(open_at: Optional[str]):
+    """(utc datetime, None) for an absolute time, (None, minute of week) for a local wall-clock time"""
+    if not open_at: return None, None
+    try:
+        when = datetime.fromisoformat(open_at.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="open_at must be an ISO 8601 datetime")
+    if when.tzinfo:
+        return when.astimezone(timezone.utc), None
+    return None, minute_of_week(when)
+
+def apply_hours_filters(results: List[dict], search: SearchRequest, open_at) -> List[dict]:
+    """Sets is_open_now on every result, then applies open_now / open_at. Unknown hours never
+    pass; a place whose local time is unknown (no time_zone, no caller offset) is kept."""
+    now = datetime.now(timezone.utc)
+    at_utc, at_local_minute = open_at
+    kept = []
+    for r in results:
+        intervals = r.pop("hours_intervals", None)
+        if intervals is None:
+            intervals = parse_hours_schedule(r.get("hours_schedule"))  # Rows ingested before the index
+        time_zone = r.get("time_zone")   # Kept: the card passes it back to /api/reviews
+        local_now = place_minute_of_week(now, time_zone, search.utc_offset_minutes)
+
+        r["is_open_now"] = hours_open_at(intervals, local_now)
+        if search.open_now and (intervals is None or r["is_open_now"] is False):
+            continue
+        if at_utc or at_local_minute is not None:
+            minute = at_local_minute if at_local_minute is not None else \
+                place_minute_of_week(at_utc, time_zone, search.utc_offset_minutes)
+            if intervals is None or hours_open_at(intervals, minute) is False:
+                continue
+        kept.append(r)
+    return kept
+
+# --- GOOGLE PLACES SEARCH CACHE ---
+# Keyed on normalized query + a geo cell and the bias is centered on the cell, so everyone in
+# the cell gets the same answer. The cell scales with the bias radius (side <= radius / 4),
+# so snapping the center never moves a tight ring's bias far from the user.
+# Only the fields we map are kept; error bodies are never cached.
+PLACES_BIAS_RADIUS_METERS = 30000.0
+PLACES_CACHE_CELL_DEGREES = (0.1, 0.05, 0.02, 0.01)   # Largest that fits the radius is used
+PLACES_CACHE_TTL_SECONDS = 6 * 3600
+METERS_PER_DEGREE_LAT = 111320.0
+
+places_cache = Cache("places", PLACES_CACHE_TTL_SECONDS)
+
+def places_cell_degrees(radius_meters: float) -> float:
+    limit = radius_meters / 4 / METERS_PER_DEGREE_LAT
+    return next((size for size in PLACES_CACHE_CELL_DEGREES if size <= limit), PLACES_CACHE_CELL_DEGREES[-1])
+
+def places_cell_center(lat: float, lng: float, radius_meters: float = PLACES_BIAS_RADIUS_METERS):
+    size = places_cell_degrees(radius_meters)
+    return (math.floor(lat / size) + 0.5) * size, (math.floor(lng / size) + 0.5) * size
+
+def places_cache_key(query: str, location: Optional[str], lat=None, lng=None,
+                     radius_meters: float = PLACES_BIAS_RADIUS_METERS) -> str:
     if lat and lng:
-        text_query = f"{query} gluten-free"
-    else:
-        text_query = f"{query} gluten-free in {location}"
+        clat, clng = places_cell_center(lat, lng, radius_meters)
+        return f"{normalize_query(query)}|{clat:.3f},{clng:.3f}"
+    return f"{normalize_query(query)}|{canonicalize_address(location)}"
 
-    url = "https://places.googleapis.com/v1/places:searchText"
-    field_mask = "places.displayName,places.formattedAddress,places.rating,places.id,places.location,places.regularOpeningHours,places.businessStatus,places.types,places.priceLevel"
-    headers = {"Content-Type": "application/json", "X-Goog-Api-Key": GOOGLE_KEY, "X-Goog-FieldMask": field_mask}
-    
-    payload = {
-        "textQuery": text_query, 
-        "minRating": 3.5, 
-        "maxResultCount": 30
+def compact_place(place: dict) -> dict:
+    """Just what search_restaurants maps (drops opening-hours periods, language codes, etc.)"""
+    weekday_hours = place.get("regularOpeningHours", {}).get("weekdayDescriptions", [])
+    return {
+        "id": place.get("id"),
+        "displayName": {"text": place.get("displayName", {}).get("text")},
+        "formattedAddress": place.get("formattedAddress", ""),
+        "rating": place.get("rating"),
+        "location": place.get("location", {}),
+        "regularOpeningHours": {"weekdayDescriptions": weekday_hours},
+        "hoursIntervals": parse_hours_schedule(weekday_hours),
+        "timeZone": (place.get("timeZone") or {}).get("id"),
+        "types": place.get("types", []),
+        "priceLevel": place.get("priceLevel"),
     }
 
-    if lat and lng:
+# Paging + tiling. Defaults keep the single 30-result call; dense metros can raise
+# GOOGLE_SEARCH_MAX_PAGES, and radii above PLACES_TILE_RADIUS_METERS are split into
+# 7 sub-circles (center + hex ring of radius R/2 covers the full R disk).
+GOOGLE_SEARCH_MAX_PAGES = int(os.getenv("GOOGLE_SEARCH_MAX_PAGES", "1"))
+GOOGLE_SEARCH_MAX_CALLS = 8          # Hard cap on Places calls per search, pages + tiles
+GOOGLE_SEARCH_PAGE_SIZE = 20
+PLACES_TILE_RADIUS_METERS = 30000.0
+PLACES_SEARCH_URL = "https://places.googleapis.com/v1/places:searchText"
+PLACES_FIELD_MASK = "places.displayName,places.formattedAddress,places.rating,places.id,places.location,places.regularOpeningHours,places.timeZone,places.businessStatus,places.types,places.priceLevel,nextPageToken"
+
+places_stats = {"searches": 0, "api_calls": 0, "pages": 0, "tiles": 0, "capped_searches": 0, "errors": 0}
+_places_stats_lock = threading.Lock()
+
+def _count_places(stat: str, n: int = 1):
+    with _places_stats_lock:
+        places_stats[stat] += n
+
+class CallBudget:
+    """Thread-safe countdown shared by every page/tile request of one search"""
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self.used = 0
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                self.exhausted = True
+                return False
+            self.remaining -= 1
+            self.used += 1
+            return True
+
+def places_tiles(lat: float, lng: float, radius_meters: float):
+    """[(lat, lng, radius)] circles covering the search disk"""
+    if radius_meters <= PLACES_TILE_RADIUS_METERS:
+        return [(lat, lng, radius_meters)]
+    sub_radius = radius_meters / 2
+    ring_miles = (radius_meters * math.sqrt(3) / 2) / 1609.34
+    tiles = [(lat, lng, sub_radius)]
+    for k in range(6):
+        bearing = math.radians(60 * k)
+        dlat = ring_miles * math.cos(bearing) / MILES_PER_DEGREE_LAT
+        dlng = ring_miles * math.sin(bearing) / (MILES_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        tiles.append((lat + dlat, lng + dlng, sub_radius))
+    return tiles
+
+def _places_search_circle(text_query: str, circle, max_pages: int, budget: CallBudget):
+    """Pages through one (biased) text search. Returns (places, error_body or None)."""
+    headers = {"Content-Type": "application/json", "X-Goog-Api-Key": GOOGLE_KEY, "X-Goog-FieldMask": PLACES_FIELD_MASK}
+    payload = {"textQuery": text_query, "minRating": 3.5}
+    if max_pages > 1:
+        payload["pageSize"] = GOOGLE_SEARCH_PAGE_SIZE
+    else:
+        payload["maxResultCount"] = 30
+    if circle:
         payload["locationBias"] = {
             "circle": {
-                "center": {"latitude": lat, "longitude": lng},
-                "radius": 30000.0
+                "center": {"latitude": circle[0], "longitude": circle[1]},
+                "radius": circle[2]
             }
         }
 
-    return requests.post(url, json=payload, headers=headers).json()
+    places = []
+    for _ in range(max_pages):
+        if not budget.take(): break
+        _count_places("api_calls")
+        try:
+            def post_page():
+                resp = requests.post(PLACES_SEARCH_URL, json=payload, headers=headers, timeout=10)
+                return {"status_code": resp.status_code, "body": resp.json()}
+            reply = upstream_call("places", {**payload, "field_mask": PLACES_FIELD_MASK}, post_page)
+            status_code, data = reply["status_code"], reply["body"]
+        except Exception as e:
+            _count_places("errors")
+            logger.error(f"Google Places Error: {e}")
+            return places, {}
+        # Never cache an error body (quota, bad key, 5xx...)
+        if status_code != 200 or "error" in data:
+            _count_places("errors")
+            logger.error(f"Google Places Error: {status_code} {data.get('error', {}).get('message', '')}")
+            return places, data
+        _count_places("pages")
+        places.extend(data.get("places", []))
+        if not data.get("nextPageToken"): break
+        payload["pageToken"] = data["nextPageToken"]
+    return places, None
+
+def fetch_google_search(query: str, location: str, lat: float = None, lng: float = None,
+                        radius_meters: float = PLACES_BIAS_RADIUS_METERS, max_pages: int = GOOGLE_SEARCH_MAX_PAGES,
+                        budget: Optional[CallBudget] = None):
+    """One (possibly tiled) text search. Pass `budget` to share one call cap (and one
+    `searches` count) across several calls made for the same user search."""
+    key = places_cache_key(query, location, lat, lng, radius_meters)
+    if radius_meters != PLACES_BIAS_RADIUS_METERS or max_pages != 1:
+        key = f"{key}|r{int(radius_meters)}|p{max_pages}"
+    places = places_cache.get(key)
+    if places is not MISSING:
+        return {"places": places}
 
+    if lat and lng:
+        text_query = f"{query} gluten-free"
+        center_lat, center_lng = places_cell_center(lat, lng, radius_meters)
+        circles = places_tiles(center_lat, center_lng, radius_meters)
+    else:
+        text_query = f"{query} gluten-free in {location}"
+        circles = [None]
+
+    own_budget = budget is None
+    if own_budget:
+        _count_places("searches")
+        budget = CallBudget(GOOGLE_SEARCH_MAX_CALLS)
+    _count_places("tiles", len(circles))
+    if len(circles) == 1:
+        outcomes = [_places_search_circle(text_query, circles[0], max_pages, budget)]
+    else:
+        with ThreadPoolExecutor(max_workers=len(circles)) as pool:
+            outcomes = list(pool.map(lambda c: _places_search_circle(text_query, c, max_pages, budget), circles))
+    if own_budget and budget.exhausted:
+        _count_places("capped_searches")
+
+    # Deduplicate by place id (tiles overlap, pages don't)
+    merged = OrderedDict()
+    for found, _ in outcomes:
+        for p in found:
+            if p.get("id") and p["id"] not in merged:
+                merged[p["id"]] = compact_place(p)
+    places = list(merged.values())
+
+    errors = [err for _, err in outcomes if err is not None]
+    if errors:
+        if not places:
+            return errors[0]
+        return {"places": places}  # Partial answer: serve it, but don't cache it
+    if budget.exhausted:
+        return {"places": places}  # Truncated by the call cap: same
+
+    places_cache.set(key, places)
+    return {"places": places}
+
+
+# Incremental review fetching
+SERPAPI_MAX_PAGES = 3       # Hard cap on pages per refresh
+MAX_STORED_REVIEWS = 50     # Matches what the AI sees (top 50)
+
+def parse_timestamp(value):
+    """ISO string (with 'Z' or offset) -> aware datetime, or None"""
+    if not value: return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
 
-def fetch_serpapi_reviews(place_id: str):
+def review_text_key(author: Optional[str], text: Optional[str]) -> str:
+    return f"{author or ''}|{(text or '')[:80]}"
+
+def review_key(r: dict) -> str:
+    """Stable identity for a stored Google review (older rows have no review_id)"""
+    if r.get("review_id"):
+        return r["review_id"]
+    return review_text_key(r.get("author"), r.get("text"))
+
+def review_keys(r: dict) -> set:
+    """Every key a review may be known by: a fresh copy of a legacy (id-less) review
+    only matches it on author + text"""
+    return {review_key(r), review_text_key(r.get("author"), r.get("text"))}
+
+# Same page requested twice within the hour (double clicks, concurrent cards) -> one SerpApi call
+SERPAPI_CACHE_TTL_SECONDS = 3600
+serpapi_cache = Cache("serpapi", SERPAPI_CACHE_TTL_SECONDS)
+
+def fetch_serpapi_reviews(place_id: str, known_ids: Optional[set] = None, newest_seen: Optional[str] = None):
+    """
+    First fetch (known_ids is None): one page sorted by qualityScore, same as always.
+    Refresh (known_ids given): newest first, paging only until a review we've already
+    stored (or one older than newest_seen) shows up. Returns only unseen reviews,
+    so an unchanged place costs a single call.
+    """
     if not SERPAPI_KEY:
         logger.error("Error: Missing SerpApi Key")
         return []
 
     url = "https://serpapi.com/search"
+    incremental = known_ids is not None
     params = {
         "engine": "google_maps_reviews",
         "place_id": place_id, 
         "api_key": SERPAPI_KEY,
         "query": "gluten celiac", 
-        "sort_by": "qualityScore",
+        "sort_by": "newestFirst" if incremental else "qualityScore",
         "hl": "en" 
     }
+    newest_seen_dt = parse_timestamp(newest_seen)
 
+    collected = []
     try:
-        logger.error(f"Calling SerpApi for Place ID: {place_id}")
-        response = requests.get(url, params=params)
-        data = response.json()
-        
-        if "error" in data:
-            logger.error("SerpApi Error:", data["error"])
-            return []
-            
-        return data.get("reviews", [])
+        for page in range(SERPAPI_MAX_PAGES if incremental else 1):
+            page_key = hashlib.sha1(json.dumps({k: v for k, v in params.items() if k != "api_key"}, sort_keys=True).encode()).hexdigest()
+            data = serpapi_cache.get(page_key)
+            if data is MISSING:
+                logger.info(f"Calling SerpApi for Place ID: {place_id} (page {page + 1})")
+                data = upstream_call("serpapi", params, lambda: requests.get(url, params=params).json())
+                
+                if "error" in data:
+                    logger.error(f"SerpApi Error: {data['error']}")
+                    break
+                serpapi_cache.set(page_key, {"reviews": data.get("reviews", []),
+                                             "serpapi_pagination": data.get("serpapi_pagination")})
+
+            reached_known = False
+            for r in data.get("reviews", []):
+                rid = r.get("review_id")
+                text_key = review_text_key(r.get("user", {}).get("name", "Anonymous"), r.get("snippet", ""))
+                review_dt = parse_timestamp(r.get("iso_date"))
+                if incremental and ((rid and rid in known_ids) or text_key in known_ids or
+                                    (newest_seen_dt and review_dt and review_dt <= newest_seen_dt)):
+                    reached_known = True
+                    break
+                collected.append(r)
+
+            next_token = (data.get("serpapi_pagination") or {}).get("next_page_token")
+            if reached_known or not next_token:
+                break
+            params["next_page_token"] = next_token
+
+        return collected
 
     except Exception as e:
         logger.error(f"SerpApi Exception: {str(e)}")
-        return []
+        return collected
+
+def merge_google_reviews(new_reviews: List[dict], stored_reviews: List[dict]) -> List[dict]:
+    """New reviews first (so a legacy copy picks up its review_id), de-duplicated by review id
+    or author + text, capped at MAX_STORED_REVIEWS"""
+    merged, seen = [], set()
+    for r in new_reviews + stored_reviews:
+        keys = review_keys(r)
+        if keys & seen: continue
+        seen.update(keys)
+        merged.append(r)
+    return merged[:MAX_STORED_REVIEWS]
+
+# --- COLUMN PROJECTIONS ---
+# Never select("*") on restaurants: the legacy `reviews` blob (up to ~50 review texts)
+# dwarfs everything else in the row. Google reviews now live in `restaurant_reviews`.
+SEARCH_HYDRATE_COLUMNS = (
+    "place_id, last_updated, wise_bites_score, ai_safety_score, ai_summary, "
+    "is_dedicated_gluten_free, has_dedicated_fryer, has_gf_menu, "
+    "relevant_count, community_review_count, average_safety_rating, "
+    "google_types, price_level, lat, lng, hours_schedule, hours_intervals, time_zone, rating"
+)
+REVIEW_DETAIL_COLUMNS = (
+    "place_id, last_updated, relevant_count, average_safety_rating, ai_safety_score, "
+    "wise_bites_score, ai_summary, is_dedicated_gluten_free, "
+    "serpapi_review_ids, newest_review_date, needs_resummary, "
+    "name, address, city, rating, hours_schedule"
+)
+REVIEW_PLACE_FIELDS = ("place_id", "name", "address", "city", "rating", "hours_schedule")  # GET /api/reviews only
+
+# --- SCHEMA ---
+# Tables and columns the API reads and writes beyond the original restaurants / user_reviews /
+# profiles schema. Idempotent; run it (python api/index.py print-schema) in the Supabase SQL
+# editor before deploying. A missing column fails the restaurants read, which is answered with
+# a 503 rather than treated as "not analyzed yet" (that would re-buy SerpApi + Groq every call).
+SCHEMA_DDL = """
+alter table public.restaurants
+    add column if not exists hours_intervals jsonb,
+    add column if not exists time_zone text,
+    add column if not exists serpapi_review_ids jsonb,
+    add column if not exists newest_review_date timestamptz,
+    add column if not exists needs_resummary boolean not null default false;
+
+create table if not exists public.restaurant_reviews (
+    place_id text not null references public.restaurants (place_id) on delete cascade,
+    position integer not null,
+    review_key text not null,
+    review jsonb not null,
+    primary key (place_id, position)
+);
+alter table public.restaurant_reviews enable row level security;
+drop policy if exists "restaurant_reviews are public" on public.restaurant_reviews;
+create policy "restaurant_reviews are public" on public.restaurant_reviews for select using (true);
+
+alter table public.user_reviews
+    add column if not exists relevance_score real,
+    add column if not exists matched_terms jsonb,
+    add column if not exists negated_terms jsonb;
+"""
+
+def print_schema():
+    print(SCHEMA_DDL + CACHE_ENTRIES_DDL)
+
+def payload_bytes(data) -> int:
+    """Approximate wire size of a Supabase response body"""
+    try:
+        return len(json.dumps(data, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+def load_stored_reviews(place_id: str) -> List[dict]:
+    """Lazily loads the stored Google reviews for one place (detail page / refresh only)."""
+    try:
+        resp = supabase.table("restaurant_reviews")\
+            .select("review")\
+            .eq("place_id", place_id)\
+            .order("position")\
+            .execute()
+        if resp.data:
+            return [row["review"] for row in resp.data]
+    except Exception as e:
+        logger.error(f"Stored Reviews Read Error: {e}")
+
+    # Rows analyzed before the split still carry the inline blob
+    try:
+        legacy = supabase.table("restaurants").select("reviews").eq("place_id", place_id).execute()
+        if legacy.data:
+            return legacy.data[0].get("reviews") or []
+    except Exception as e:
+        logger.error(f"Legacy Reviews Read Error: {e}")
+    return []
+
+def save_stored_reviews(place_id: str, reviews: List[dict]):
+    """Replaces the stored Google reviews for one place. Raises on failure: the caller must
+    not mark these reviews as seen unless they were actually written."""
+    supabase.table("restaurant_reviews").delete().eq("place_id", place_id).execute()
+    if reviews:
+        supabase.table("restaurant_reviews").insert([
+            {"place_id": place_id, "review_key": review_key(r), "position": i, "review": r}
+            for i, r in enumerate(reviews)
+        ]).execute()
     
+def migrate_legacy_reviews():
+    """Offline job: moves pre-split inline `reviews` blobs into restaurant_reviews (python api/index.py migrate-legacy-reviews)"""
+    split_places = {row["place_id"] for row in _iter_table_pages("restaurant_reviews", "place_id", ["place_id", "position"])}
+    moved = failed = 0
+    for row in iter_restaurant_rows("place_id, reviews"):
+        if row["place_id"] in split_places or not row.get("reviews"): continue
+        try:
+            save_stored_reviews(row["place_id"], row["reviews"][:MAX_STORED_REVIEWS])
+            moved += 1
+        except Exception as e:
+            failed += 1
+            logger.error(f"Legacy Reviews Migration Error for {row['place_id']}: {e}")
+    print(f"Moved reviews for {moved} restaurants ({failed} failed)")
+
 def check_and_update_limit(user_id: str):
     """
     Returns True if user is allowed to search.
@@ -406,13 +1977,1184 @@ def check_and_update_limit(user_id: str):
         }).eq("id", user_id).execute()
 
         return True
-        
-    except Exception as e:
-        logger.error(f"Limit Check Error: {e}")
-        return True
+        
+    except Exception as e:
+        logger.error(f"Limit Check Error: {e}")
+        return True
+
+# --- SEARCH SORTING ---
+def sort_relevant(x):
+    # 1. Verified Scores First (High -> Low)
+    # 2. Distance Second (Low -> High)
+    wb = x.get("wise_bites_score") or 0
+    dist = x.get("distance_miles") or 9999
+    
+    # Tuple Sort: (HasNoScore?, -Score, Distance)
+    # If WB=8.0: (0, -8.0, dist) -> Smaller 1st item floats to top
+    # If WB=None: (1, 0, dist) -> Larger 1st item sinks
+    has_no_score = 0 if wb > 0 else 1
+    return (has_no_score, -wb, dist)
+
+def sort_top_rated(x):
+    # 1. Verified Scores First (High -> Low)
+    # 2. Google Ratings Second (High -> Low)
+    wb = x.get("wise_bites_score") or 0
+    rating = x.get("rating") or 0
+    
+    # Verified always beats Unverified.
+    has_no_score = 0 if wb > 0 else 1
+    return (has_no_score, -wb, -rating)
+
+def sort_distance(x):
+    # Strict Distance (Low -> High)
+    return x.get("distance_miles") or 9999
+
+def sort_reviews(x):
+    # Most Reviewed (High -> Low)
+    return -(x.get("relevant_count") or 0)
+
+def sort_search_results(final_list: List[dict], sort_by: Optional[str], has_location: bool):
+    """Sorts in place using the same modes the dashboard exposes"""
+    sort_mode = sort_by or "relevant"
+
+    # APPLY SORT
+    if sort_mode == "top_rated":
+        final_list.sort(key=sort_top_rated) 
+    elif sort_mode == "distance":
+        final_list.sort(key=sort_distance)
+    elif sort_mode == "reviews":
+        final_list.sort(key=sort_reviews)
+    else:
+        # Default / Relevant
+        if has_location: 
+            final_list.sort(key=sort_relevant)
+        else: 
+            # Fallback if no location data available
+            final_list.sort(key=lambda x: x.get("rating", 0), reverse=True)
+
+# --- SEARCH RESPONSE CACHE ---
+# Identical searches seconds apart skip Google, the RPC, the hydrate, the merge and the sort.
+# Keyed by normalized query + quantized geo cell + premium filters + caller offset + sort_by.
+# Open-now / open-at searches depend on the clock, so they are never cached.
+SEARCH_CACHE_TTL_SECONDS = 120
+SEARCH_CACHE_MAX_ENTRIES = 256
+GEO_CELL_DEGREES = 0.01  # ~0.7 miles; distances are recomputed per caller on a hit
+
+_search_cache = OrderedDict()    # key -> (expires_at, cell, response_body)
+_search_cache_by_place = {}      # place_id -> set(keys) for invalidation
+_search_cache_by_cell = {}       # cell -> set(keys) for invalidation
+_search_cache_lock = threading.Lock()   # Sync endpoints run on threadpool workers
+
+def normalize_query(text: Optional[str]) -> str:
+    return " ".join((text or "").lower().split())
+
+def geo_cell(lat, lng):
+    if lat is None or lng is None: return None
+    return (math.floor(lat / GEO_CELL_DEGREES), math.floor(lng / GEO_CELL_DEGREES))
+
+def search_cache_key(search: SearchRequest, lat, lng, location: Optional[str]):
+    cell = geo_cell(lat, lng)
+    return (
+        normalize_query(search.query),
+        cell if cell else normalize_query(location),
+        bool(search.filter_dedicated_gf),
+        bool(search.filter_dedicated_fryer),
+        bool(search.filter_gf_menu),
+        search.utc_offset_minutes,   # is_open_now of places without a time_zone depends on it
+        search.sort_by or "relevant",
+    )
+
+def _drop_search_entry(key):
+    """Caller holds _search_cache_lock"""
+    entry = _search_cache.pop(key, None)
+    if not entry: return
+    _, cell, body = entry
+    for r in body["results"]:
+        keys = _search_cache_by_place.get(r["place_id"])
+        if keys:
+            keys.discard(key)
+            if not keys: _search_cache_by_place.pop(r["place_id"], None)
+    cell_keys = _search_cache_by_cell.get(cell)
+    if cell_keys:
+        cell_keys.discard(key)
+        if not cell_keys: _search_cache_by_cell.pop(cell, None)
+
+def get_cached_search_response(key, user_lat, user_lon, sort_by):
+    with _search_cache_lock:
+        entry = _search_cache.get(key)
+        if not entry: return None
+        expires_at, _, body = entry
+        if time.monotonic() > expires_at:
+            _drop_search_entry(key)
+            return None
+        _search_cache.move_to_end(key)
+
+    # Same cell != same spot: re-derive distances for this caller, then re-sort
+    results = [dict(r) for r in body["results"]]
+    if user_lat and user_lon:
+        for r in results:
+            loc = r.get("location") or {}
+            dist = calculate_distance(user_lat, user_lon, loc.get("lat"), loc.get("lng"))
+            if dist is not None:
+                r["distance_miles"] = round(dist, 2)
+        sort_search_results(results, sort_by, True)
+    return {**body, "results": results}
+
+def store_search_response(key, body):
+    cell = key[1] if isinstance(key[1], tuple) else None
+    body = copy.deepcopy(body)
+    with _search_cache_lock:
+        _drop_search_entry(key)
+        _search_cache[key] = (time.monotonic() + SEARCH_CACHE_TTL_SECONDS, cell, body)
+        for r in body["results"]:
+            _search_cache_by_place.setdefault(r["place_id"], set()).add(key)
+        if cell:
+            _search_cache_by_cell.setdefault(cell, set()).add(key)
+        while len(_search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+            _drop_search_entry(next(iter(_search_cache)))
+
+def invalidate_search_cache(place_id: str, lat=None, lng=None):
+    """Called when a place gets a new analysis or community review"""
+    with _search_cache_lock:
+        keys = set(_search_cache_by_place.get(place_id, ()))
+        keys.update(_search_cache_by_cell.get(geo_cell(lat, lng), ()))
+        for key in keys:
+            _drop_search_entry(key)
+
+# --- ETAGS ---
+def make_etag(body) -> str:
+    digest = hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+    return f'"{digest[:20]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match: return False
+    if if_none_match.strip() == "*": return True
+    candidates = [t.strip() for t in if_none_match.split(",")]
+    return any(t.replace("W/", "", 1) == etag for t in candidates)
+
+def respond_with_etag(body, http_response: Response, if_none_match: Optional[str]):
+    """Sets the ETag header; returns a bare 304 if the client already has this body"""
+    etag = make_etag(body)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    http_response.headers["ETag"] = etag
+    return body
+
+# --- REQUEST PROFILING ---
+# Opt-in statistical profile of one /api/search or /api/reviews request. Triggered by an
+# X-Profile-Token header matching PROFILE_TOKEN, or for PROFILE_SAMPLE_RATE of requests.
+# A sampler thread reads the handler thread's stack every PROFILE_INTERVAL_SECONDS (wall
+# clock, so time blocked on sockets/futures shows up) and writes collapsed stacks
+# ("frame;frame;frame count", the flamegraph.pl / speedscope input) plus a JSON breakdown
+# to PROFILE_DIR. When off, the cost is one header compare and one random() per request.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_SECONDS = 0.005
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/safebites-profiles")   # /tmp is the writable dir on Vercel
+PROFILE_TOP_FUNCTIONS = 15
+_profile_slot = threading.Semaphore(1)   # One profiled request at a time bounds the overhead
+
+def should_profile(x_profile_token: Optional[str]) -> bool:
+    if x_profile_token:
+        return bool(PROFILE_TOKEN) and x_profile_token == PROFILE_TOKEN
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class RequestProfile:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.profile_id = f"{endpoint}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{os.urandom(3).hex()}"
+        self.stacks = {}     # "root;...;leaf" -> samples
+        self.samples = 0
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_INTERVAL_SECONDS):
+            frame = sys._current_frames().get(self._target)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            if not labels: continue
+            key = ";".join(reversed(labels))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._sampler.join()
+        wall_ms = (time.perf_counter() - self._started) * 1000
+        self_samples, total_samples = {}, {}
+        for stack, n in self.stacks.items():
+            frames = stack.split(";")
+            self_samples[frames[-1]] = self_samples.get(frames[-1], 0) + n
+            for label in set(frames):
+                total_samples[label] = total_samples.get(label, 0) + n
+
+        def top(counts):
+            return [{"function": label, "ms": round(n * PROFILE_INTERVAL_SECONDS * 1000, 1),
+                     "share": round(n / self.samples, 3)}
+                    for label, n in heapq.nlargest(PROFILE_TOP_FUNCTIONS, counts.items(), key=lambda kv: kv[1])]
+
+        return {
+            "profile_id": self.profile_id,
+            "endpoint": self.endpoint,
+            "wall_ms": round(wall_ms, 1),
+            "samples": self.samples,
+            "interval_ms": PROFILE_INTERVAL_SECONDS * 1000,
+            "self": top(self_samples) if self.samples else [],
+            "inclusive": top(total_samples) if self.samples else [],
+        }
+
+    def save(self, summary: dict):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.profile_id)
+        with open(f"{base}.folded", "w") as f:
+            for stack, n in sorted(self.stacks.items()):
+                f.write(f"{stack} {n}\n")
+        with open(f"{base}.json", "w") as f:
+            json.dump(summary, f, indent=2)
+
+@contextmanager
+def profile_request(endpoint: str, x_profile_token: Optional[str], http_response: Response):
+    """`with profile_request("search", x_profile_token, http_response):` around a handler body"""
+    if not should_profile(x_profile_token) or not _profile_slot.acquire(blocking=False):
+        yield
+        return
+    try:
+        profile = RequestProfile(endpoint)
+        http_response.headers["X-Profile-Id"] = profile.profile_id
+        profile.start()
+        try:
+            yield
+        finally:
+            summary = profile.stop()
+            try:
+                profile.save(summary)
+                logger.info(f"Profiled {endpoint}: {summary['wall_ms']} ms, {summary['samples']} samples "
+                            f"-> {PROFILE_DIR}/{profile.profile_id}.folded")
+            except Exception as e:
+                logger.error(f"Profile Save Error: {e}")
+    finally:
+        _profile_slot.release()
+
+@app.get("/api/profiles/{profile_id}")
+def get_profile(profile_id: str, format: str = "folded", x_metrics_token: Optional[str] = Header(None)):
+    """Fetches a saved profile (serverless /tmp isn't reachable any other way)"""
+    require_metrics_token(x_metrics_token)
+    if not re.fullmatch(r"[a-z]+-\d{8}T\d{6}-[0-9a-f]{6}", profile_id) or format not in ("folded", "json"):
+        raise HTTPException(status_code=400, detail="Bad profile id or format")
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.{format}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found on this instance")
+    with open(path) as f:
+        body = f.read()
+    return Response(content=body, media_type="application/json" if format == "json" else "text/plain")
+
+# --- TYPEAHEAD SUGGESTIONS ---
+# Prefix index over restaurant names, cities and cuisine types we already store, so the search
+# box can suggest known places before anything reaches Places text search. Kept as one sorted
+# list of (word, kind, key) searched with bisect; fed by the spatial index as it loads/refreshes
+# and by get_reviews writes, so it never scans the table on the request path.
+SUGGEST_DEFAULT_LIMIT = 8
+SUGGEST_MAX_LIMIT = 20
+SUGGEST_SCAN_LIMIT = 100         # Prefix matches examined per request (keeps 1-letter queries cheap)
+SUGGEST_CDN_MAX_AGE = 60
+SUGGEST_SKIP_TYPES = {"restaurant", "food", "point_of_interest", "establishment", "store",
+                      "meal_takeaway", "meal_delivery"}
+
+class SuggestIndex:
+    def __init__(self):
+        self.keys = []       # sorted (word, kind, key)
+        self.places = {}     # place_id -> (name, city, types, score)
+        self.labels = {}     # (kind, key) -> display text, for city/cuisine entries
+        self.counts = {}     # (kind, key) -> restaurants referencing it
+        self._bulk = False   # While build() runs: keys are appended, then sorted once
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        return normalize_query(re.sub(r"[^\w\s]", " ", text or "")).split()
+
+    def _words(self, text: str) -> List[str]:
+        return sorted(set(self._tokens(text)))
+
+    def _add_key(self, kind: str, key: str, text: str):
+        for word in self._words(text):
+            if self._bulk:
+                self.keys.append((word, kind, key))
+            else:
+                bisect.insort(self.keys, (word, kind, key))
+
+    def _drop_key(self, kind: str, key: str, text: str):
+        for word in self._words(text):
+            i = bisect.bisect_left(self.keys, (word, kind, key))
+            if i < len(self.keys) and self.keys[i] == (word, kind, key):
+                del self.keys[i]
+
+    def _ref(self, kind: str, key: str, label: str, delta: int):
+        ref = (kind, key)
+        n = self.counts.get(ref, 0) + delta
+        if n > 0:
+            if ref not in self.counts:
+                self.labels[ref] = label
+                self._add_key(kind, key, label)
+            self.counts[ref] = n
+        elif ref in self.counts:
+            del self.counts[ref]
+            self._drop_key(kind, key, self.labels.pop(ref))
+
+    def _remove(self, pid: str):
+        old = self.places.pop(pid, None)
+        if not old: return
+        name, city, types, _ = old
+        self._drop_key("restaurant", pid, name)
+        if city: self._ref("city", city.lower(), city, -1)
+        for t in types: self._ref("cuisine", t, t.replace("_", " "), -1)
+
+    def put(self, row: dict):
+        """Adds/updates a restaurant. Fields the row doesn't carry (name, city, google_types,
+        score) keep what is already indexed; only remove() takes a place out."""
+        pid = row["place_id"]
+        with self._lock:
+            old = self.places.get(pid)
+            name = row.get("name") or (old[0] if old else None)
+            if not name: return
+            city = row.get("city") or (old[1] if old else None)
+            types = row.get("google_types")
+            if types is None:
+                types = old[2] if old else ()
+            types = tuple(t for t in types if t not in SUGGEST_SKIP_TYPES)
+            if "wise_bites_score" in row:
+                score = float(row["wise_bites_score"]) if row["wise_bites_score"] else None
+            else:
+                score = old[3] if old else None
+            self._remove(pid)
+            self.places[pid] = (name, city, types, score)
+            self._add_key("restaurant", pid, name)
+            if city: self._ref("city", city.lower(), city, 1)
+            for t in types: self._ref("cuisine", t, t.replace("_", " "), 1)
+
+    def remove(self, pid: str):
+        with self._lock:
+            self._remove(pid)
+
+    @classmethod
+    def build(cls, rows) -> "SuggestIndex":
+        """Full load: one sort instead of an insort per word (O(N log N), not O(N^2))"""
+        fresh = cls()
+        fresh._bulk = True
+        for row in {row["place_id"]: row for row in rows}.values():  # Unique, so nothing is dropped mid-build
+            fresh.put(row)
+        fresh.keys.sort()
+        fresh._bulk = False
+        return fresh
+
+    def replace_with(self, fresh: "SuggestIndex"):
+        with self._lock:
+            self.keys, self.places, self.labels, self.counts = fresh.keys, fresh.places, fresh.labels, fresh.counts
+
+    def suggest(self, query: str, limit: int = SUGGEST_DEFAULT_LIMIT) -> List[dict]:
+        """Last word is a prefix, earlier words must match whole words of the same entry"""
+        words = self._tokens(query)
+        if not words: return []
+        prefix, whole = words[-1], words[:-1]
+        with self._lock:
+            hits = {}
+            i = bisect.bisect_left(self.keys, (prefix,))
+            for word, kind, key in self.keys[i:i + SUGGEST_SCAN_LIMIT]:
+                if not word.startswith(prefix): break
+                hits[(kind, key)] = word == prefix
+            out = []
+            for (kind, key), exact in hits.items():
+                if kind == "restaurant":
+                    name, city, _, score = self.places[key]
+                    text = name
+                else:
+                    text = self.labels[(kind, key)]
+                tokens = self._tokens(text)
+                if any(w not in tokens for w in whole): continue
+                starts = len(tokens) > len(whole) and tokens[:len(whole)] == whole \
+                    and tokens[len(whole)].startswith(prefix)
+                if kind == "restaurant":
+                    out.append(((starts, exact, score or 0), {
+                        "type": "restaurant", "text": name, "place_id": key, "city": city,
+                        "wise_bites_score": score}))
+                else:
+                    count = self.counts[(kind, key)]
+                    item = {"type": kind, "text": text, "count": count}
+                    if kind == "cuisine": item["google_type"] = key
+                    out.append(((starts, exact, count), item))
+        out.sort(key=lambda x: x[0], reverse=True)
+        return [item for _, item in out[:limit]]
+
+suggest_index = SuggestIndex()
+
+@app.get("/api/suggest")
+def get_suggestions(q: str, http_response: Response, limit: int = SUGGEST_DEFAULT_LIMIT):
+    limit = max(1, min(SUGGEST_MAX_LIMIT, limit))
+    http_response.headers["Cache-Control"] = f"public, max-age=0, s-maxage={SUGGEST_CDN_MAX_AGE}"
+    return {
+        "query": q,
+        "ready": spatial_index.loaded_at is not None,
+        "suggestions": suggest_index.suggest(q, limit),
+    }
+
+# --- IN-PROCESS SPATIAL INDEX ---
+# Grid (~17 mi cells) over every analyzed restaurant, so located searches can skip the
+# search_nearby_restaurants RPC. Loaded in the background at startup, refreshed from
+# last_updated deltas; the RPC stays the fallback while the index is cold or stale.
+SPATIAL_INDEX_CELL_DEGREES = 0.25
+SPATIAL_INDEX_REFRESH_SECONDS = 60        # Kick off a delta refresh after this long
+SPATIAL_INDEX_MAX_STALENESS = 300         # Older than this -> fall back to the RPC
+SPATIAL_INDEX_FULL_RELOAD_SECONDS = 3600  # Full reload also drops deleted rows
+SPATIAL_INDEX_PAGE_SIZE = 1000
+SPATIAL_INDEX_COLUMNS = (
+    "place_id, name, address, city, lat, lng, rating, google_types, hours_schedule, hours_intervals, "
+    "time_zone, last_updated, "
+    "wise_bites_score, ai_safety_score, ai_summary, average_safety_rating, "
+    "relevant_count, community_review_count, "
+    "is_dedicated_gluten_free, has_dedicated_fryer, has_gf_menu"
+)
+
+def iter_restaurant_rows(columns: str, since: Optional[str] = None, page_size: int = SPATIAL_INDEX_PAGE_SIZE):
+    """
+    Pages through restaurants (optionally only rows updated after `since`), keyset-paged on
+    place_id. Never on last_updated: it isn't unique and refreshes rewrite it mid-scan, so
+    offset pages over it repeat or skip rows.
+    """
+    last_id = None
+    while True:
+        q = supabase.table("restaurants").select(columns)
+        if since:
+            q = q.gt("last_updated", since)
+        if last_id is not None:
+            q = q.gt("place_id", last_id)
+        resp = q.order("place_id").limit(page_size).execute()
+        rows = resp.data or []
+        yield from rows
+        if len(rows) < page_size: break
+        last_id = rows[-1]["place_id"]
+
+def _restaurant_search_text(row: dict) -> str:
+    types = " ".join(t.replace("_", " ") for t in (row.get("google_types") or []))
+    return normalize_query(f"{row.get('name') or ''} {row.get('city') or ''} {types}")
+
+class SpatialIndex:
+    def __init__(self):
+        self.rows = {}       # place_id -> row
+        self.cells = {}      # (cell_lat, cell_lng) -> set(place_id)
+        self.text = {}       # place_id -> normalized name/city/types
+        self.max_updated = None
+        self.loaded_at = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / SPATIAL_INDEX_CELL_DEGREES), math.floor(lng / SPATIAL_INDEX_CELL_DEGREES))
+
+    def _put(self, row: dict, suggest: bool = True):
+        pid = row["place_id"]
+        self._remove(pid)
+        lat, lng = row.get("lat"), row.get("lng")
+        if lat is None or lng is None: return
+        self.rows[pid] = row
+        self.text[pid] = _restaurant_search_text(row)
+        if suggest: suggest_index.put(row)
+        self.cells.setdefault(self._cell(lat, lng), set()).add(pid)
+
+    def _remove(self, pid: str):
+        # The suggest entry stays: suggest_index.put merges the new row into it
+        old = self.rows.pop(pid, None)
+        self.text.pop(pid, None)
+        if old:
+            cell = self.cells.get(self._cell(old["lat"], old["lng"]))
+            if cell: cell.discard(pid)
+
+    def refresh(self, full: bool = False):
+        """Full load (first time / hourly) or last_updated delta. Safe to call from any thread."""
+        with self._lock:
+            if self._refreshing: return
+            self._refreshing = True
+        try:
+            full = full or self.loaded_at is None or \
+                time.monotonic() - self.loaded_at > SPATIAL_INDEX_FULL_RELOAD_SECONDS
+            scan_started = datetime.now(timezone.utc)
+            rows = list(iter_restaurant_rows(SPATIAL_INDEX_COLUMNS, None if full else self.max_updated))
+            # A full load rebuilds the suggest index off to the side, outside the spatial lock
+            fresh_suggest = SuggestIndex.build(
+                r for r in rows if r.get("lat") is not None and r.get("lng") is not None
+            ) if full else None
+            with self._lock:
+                if full:
+                    self.rows, self.cells, self.text = {}, {}, {}
+                for row in rows:
+                    self._put(row, suggest=not full)
+                    if row.get("last_updated") and (self.max_updated is None or row["last_updated"] > self.max_updated):
+                        self.max_updated = row["last_updated"]
+                # Rows written while the scan ran may sit behind its place_id cursor: keep the
+                # watermark at the scan start so the next delta picks them up
+                if self.max_updated and (parse_timestamp(self.max_updated) or scan_started) > scan_started:
+                    self.max_updated = scan_started.isoformat()
+                if full:
+                    suggest_index.replace_with(fresh_suggest)
+                now = time.monotonic()
+                if full: self.loaded_at = now
+                self.refreshed_at = now
+            logger.info(f"Spatial index {'loaded' if full else 'refreshed'}: {len(rows)} rows ({len(self.rows)} total)")
+        except Exception as e:
+            logger.error(f"Spatial Index Refresh Error: {e}")
+        finally:
+            self._refreshing = False
+
+    def apply_write(self, place_id: str, fields: dict):
+        """Folds a write we just made into the index. Writes that leave last_updated alone
+        (community re-scores) would otherwise wait for the hourly full reload."""
+        with self._lock:
+            self._put({**self.rows.get(place_id, {}), **fields, "place_id": place_id})
+
+    def all_rows(self) -> List[dict]:
+        with self._lock:
+            return list(self.rows.values())
+
+    def refresh_in_background(self, full: bool = False):
+        threading.Thread(target=self.refresh, kwargs={"full": full}, daemon=True).start()
+
+    def is_ready(self) -> bool:
+        """Loaded and fresh enough to stand in for the RPC; schedules a delta refresh when due"""
+        if self.refreshed_at is None: return False
+        age = time.monotonic() - self.refreshed_at
+        if age > SPATIAL_INDEX_REFRESH_SECONDS and not self._refreshing:
+            self.refresh_in_background()
+        return age <= SPATIAL_INDEX_MAX_STALENESS
+
+    def query(self, lat: float, lng: float, radius_miles: float, search_query: Optional[str] = None,
+              filter_dedicated_gf: bool = False, filter_dedicated_fryer: bool = False,
+              filter_gf_menu: bool = False) -> List[dict]:
+        """Radius + premium filters + text match. Rows come back shaped like the RPC's (with dist_miles)."""
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_miles)
+        lo_lat, lo_lng = self._cell(min_lat, min_lng)
+        hi_lat, hi_lng = self._cell(max_lat, max_lng)
+        tokens = normalize_query(search_query).split()
+
+        with self._lock:
+            candidates = []
+            for cl in range(lo_lat, hi_lat + 1):
+                for cg in range(lo_lng, hi_lng + 1):
+                    for pid in self.cells.get((cl, cg), ()):
+                        row = self.rows[pid]
+                        if filter_dedicated_gf and not row.get("is_dedicated_gluten_free"): continue
+                        if filter_dedicated_fryer and not row.get("has_dedicated_fryer"): continue
+                        if filter_gf_menu and not row.get("has_gf_menu"): continue
+                        if tokens and not all(t in self.text[pid] for t in tokens): continue
+                        candidates.append(row)
+
+        distances, keep = geo_filter(lat, lng, [r["lat"] for r in candidates], [r["lng"] for r in candidates], radius_miles)
+        return [{**candidates[i], "dist_miles": distances[i]} for i in keep if distances[i] is not None]
+
+spatial_index = SpatialIndex()
+
+@app.on_event("startup")
+def load_spatial_index():
+    spatial_index.refresh_in_background(full=True)
+
+# --- COLUMNAR SNAPSHOT (read-only search nodes) ---
+# `python api/index.py export-snapshot` writes the search columns of `restaurants` to
+# SNAPSHOT_DIR/restaurants-<version>.snap and flips SNAPSHOT_DIR/CURRENT. Workers mmap the
+# current file (shared pages, no load time) and swap to a new version when CURRENT changes.
+#
+# File layout: MAGIC | u32 header length | JSON header | 8-byte aligned column blocks.
+# Numeric columns are native arrays (NaN = NULL); string columns are a UTF-8 blob plus
+# n+1 int64 offsets.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+SNAPSHOT_MAGIC = b"SBSNAP1\n"
+SNAPSHOT_KEEP_VERSIONS = 3
+SNAPSHOT_CHECK_SECONDS = 30        # How often workers look for a new version
+SNAPSHOT_MAX_AGE_SECONDS = 6 * 3600  # Older snapshots are ignored (index / RPC take over)
+
+SNAPSHOT_FLOAT_COLUMNS = ["lat", "lng", "rating", "wise_bites_score", "ai_safety_score",
+                          "average_safety_rating", "last_updated"]
+SNAPSHOT_INT_COLUMNS = ["relevant_count", "community_review_count"]
+SNAPSHOT_STRING_COLUMNS = ["place_id", "name", "address", "city", "ai_summary", "google_types", "hours_schedule",
+                           "hours_intervals", "time_zone"]
+SNAPSHOT_FLAGS = {"is_dedicated_gluten_free": 1, "has_dedicated_fryer": 2, "has_gf_menu": 4}
+
+def _snapshot_value(row: dict, column: str):
+    value = row.get(column)
+    if column == "last_updated":
+        ts = parse_timestamp(value)
+        return ts.timestamp() if ts else float("nan")
+    if column in ("google_types", "hours_schedule"):
+        return json.dumps(value or [])
+    if column == "hours_intervals":
+        return json.dumps(value)  # Keeps null: unknown hours are not "always closed"
+    if column in SNAPSHOT_FLOAT_COLUMNS:
+        return float(value) if value is not None else float("nan")
+    if column in SNAPSHOT_INT_COLUMNS:
+        return int(value or 0)
+    return value or ""
+
+def write_snapshot(rows: List[dict], directory: str, version: Optional[str] = None) -> str:
+    """Serializes rows into a new versioned file and atomically points CURRENT at it"""
+    version = version or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    rows = [r for r in rows if r.get("lat") is not None and r.get("lng") is not None]
+    blocks, columns = [], {}
+
+    for col in SNAPSHOT_FLOAT_COLUMNS:
+        blocks.append((col, "d", array("d", (_snapshot_value(r, col) for r in rows)).tobytes()))
+    for col in SNAPSHOT_INT_COLUMNS:
+        blocks.append((col, "q", array("q", (_snapshot_value(r, col) for r in rows)).tobytes()))
+    flags = array("B", (sum(bit for name, bit in SNAPSHOT_FLAGS.items() if r.get(name)) for r in rows))
+    blocks.append(("flags", "B", flags.tobytes()))
+    for col in SNAPSHOT_STRING_COLUMNS:
+        encoded = [_snapshot_value(r, col).encode("utf-8") for r in rows]
+        offsets = array("q", [0])
+        for e in encoded:
+            offsets.append(offsets[-1] + len(e))
+        blocks.append((col + ".offsets", "q", offsets.tobytes()))
+        blocks.append((col, "s", b"".join(encoded)))
+
+    # Offsets are relative to the start of the data section (after the header)
+    position = 0
+    for name, fmt, data in blocks:
+        columns[name] = {"format": fmt, "offset": position, "length": len(data)}
+        position += len(data) + (-len(data) % 8)
+    header = json.dumps({"version": version, "rows": len(rows), "byteorder": sys.byteorder,
+                         "columns": columns}).encode("utf-8")
+    header += b" " * (-(len(SNAPSHOT_MAGIC) + 4 + len(header)) % 8)
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"restaurants-{version}.snap")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack("<I", len(header)) + header)
+        for _, _, data in blocks:
+            f.write(data + b"\0" * (-len(data) % 8))
+    os.replace(tmp_path, path)
+
+    pointer_tmp = os.path.join(directory, "CURRENT.tmp")
+    with open(pointer_tmp, "w") as f:
+        f.write(os.path.basename(path))
+    os.replace(pointer_tmp, os.path.join(directory, "CURRENT"))
+
+    # Prune old versions (workers still mapping them keep their pages until they swap)
+    versions = sorted(n for n in os.listdir(directory) if n.startswith("restaurants-") and n.endswith(".snap"))
+    for name in versions[:-SNAPSHOT_KEEP_VERSIONS]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+    return path
+
+def export_search_snapshot(directory: Optional[str] = None):
+    """Offline job: restaurants -> versioned columnar snapshot"""
+    directory = directory or SNAPSHOT_DIR
+    if not directory:
+        print("Set SNAPSHOT_DIR (or pass a directory) to export a snapshot")
+        return None
+    start = time.perf_counter()
+    rows = list(iter_restaurant_rows(SPATIAL_INDEX_COLUMNS))
+    path = write_snapshot(rows, directory)
+    print(f"Wrote {len(rows)} rows to {path} ({os.path.getsize(path)} bytes) in {time.perf_counter() - start:.1f}s")
+    return path
+
+class RestaurantSnapshot:
+    """Read-only, memory-mapped view of one snapshot file"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a snapshot file: {path}")
+        header_len = struct.unpack_from("<I", self._mm, len(SNAPSHOT_MAGIC))[0]
+        data_start = len(SNAPSHOT_MAGIC) + 4 + header_len
+        header = json.loads(self._mm[len(SNAPSHOT_MAGIC) + 4:data_start])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("Snapshot was written on a different byte order")
+
+        self.path = path
+        self.version = header["version"]
+        self.size = header["rows"]
+        self.created_at = os.path.getmtime(path)
+        self._data_start = data_start
+        self._columns = header["columns"]
+        view = memoryview(self._mm)
+        self._views = {}
+        for name, meta in self._columns.items():
+            start = data_start + meta["offset"]
+            block = view[start:start + meta["length"]]
+            self._views[name] = block if meta["format"] == "s" else block.cast(meta["format"])
+
+    def _numpy(self, name: str):
+        meta = self._columns[name]
+        dtype = {"d": "f8", "q": "i8", "B": "u1"}[meta["format"]]
+        return np.frombuffer(self._mm, dtype=dtype, count=self.size, offset=self._data_start + meta["offset"])
+
+    def _string(self, name: str, i: int) -> str:
+        offsets = self._views[name + ".offsets"]
+        return bytes(self._views[name][offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+    def _float(self, name: str, i: int):
+        value = self._views[name][i]
+        return None if math.isnan(value) else value
+
+    # Columns added after the first snapshot version; older files simply don't have them
+    def _optional_json(self, name: str, i: int):
+        return json.loads(self._string(name, i)) if name in self._views else None
+
+    def _optional_string(self, name: str, i: int):
+        return (self._string(name, i) or None) if name in self._views else None
+
+    def row(self, i: int) -> dict:
+        flags = self._views["flags"][i]
+        updated = self._float("last_updated", i)
+        return {
+            "place_id": self._string("place_id", i),
+            "name": self._string("name", i),
+            "address": self._string("address", i),
+            "city": self._string("city", i) or None,
+            "ai_summary": self._string("ai_summary", i) or None,
+            "google_types": json.loads(self._string("google_types", i)),
+            "hours_schedule": json.loads(self._string("hours_schedule", i)),
+            "hours_intervals": self._optional_json("hours_intervals", i),
+            "time_zone": self._optional_string("time_zone", i),
+            "lat": self._views["lat"][i],
+            "lng": self._views["lng"][i],
+            "rating": self._float("rating", i) or 0.0,
+            "wise_bites_score": self._float("wise_bites_score", i),
+            "ai_safety_score": self._float("ai_safety_score", i),
+            "average_safety_rating": self._float("average_safety_rating", i),
+            "last_updated": datetime.fromtimestamp(updated, timezone.utc).isoformat() if updated else None,
+            "relevant_count": self._views["relevant_count"][i],
+            "community_review_count": self._views["community_review_count"][i],
+            **{name: bool(flags & bit) for name, bit in SNAPSHOT_FLAGS.items()},
+        }
+
+    def query(self, lat: float, lng: float, radius_miles: float, search_query: Optional[str] = None,
+              filter_dedicated_gf: bool = False, filter_dedicated_fryer: bool = False,
+              filter_gf_menu: bool = False) -> List[dict]:
+        """Same contract as SpatialIndex.query"""
+        required = (SNAPSHOT_FLAGS["is_dedicated_gluten_free"] if filter_dedicated_gf else 0) | \
+                   (SNAPSHOT_FLAGS["has_dedicated_fryer"] if filter_dedicated_fryer else 0) | \
+                   (SNAPSHOT_FLAGS["has_gf_menu"] if filter_gf_menu else 0)
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_miles)
+
+        if np is not None:
+            lats, lngs, flags = self._numpy("lat"), self._numpy("lng"), self._numpy("flags")
+            mask = (lats >= min_lat) & (lats <= max_lat) & (lngs >= min_lng) & (lngs <= max_lng)
+            if required:
+                mask &= (flags & required) == required
+            indices = np.nonzero(mask)[0].tolist()
+        else:
+            lats, lngs, flags = self._views["lat"], self._views["lng"], self._views["flags"]
+            indices = [i for i in range(self.size)
+                       if min_lat <= lats[i] <= max_lat and min_lng <= lngs[i] <= max_lng
+                       and (flags[i] & required) == required]
+
+        tokens = normalize_query(search_query).split()
+        rows = []
+        for i in indices:
+            if tokens:
+                types = " ".join(json.loads(self._string("google_types", i)))
+                text = normalize_query(f"{self._string('name', i)} {self._string('city', i)} {types.replace('_', ' ')}")
+                if not all(t in text for t in tokens): continue
+            rows.append(self.row(i))
+
+        distances, keep = geo_filter(lat, lng, [r["lat"] for r in rows], [r["lng"] for r in rows], radius_miles)
+        return [{**rows[i], "dist_miles": distances[i]} for i in keep if distances[i] is not None]
+
+_snapshot = None
+_snapshot_checked_at = 0.0
+_snapshot_lock = threading.Lock()
+
+def current_snapshot() -> Optional[RestaurantSnapshot]:
+    """The newest snapshot in SNAPSHOT_DIR (re-checked every SNAPSHOT_CHECK_SECONDS), or None"""
+    global _snapshot, _snapshot_checked_at
+    if not SNAPSHOT_DIR: return None
+
+    if time.monotonic() - _snapshot_checked_at > SNAPSHOT_CHECK_SECONDS:
+        with _snapshot_lock:
+            _snapshot_checked_at = time.monotonic()
+            try:
+                with open(os.path.join(SNAPSHOT_DIR, "CURRENT")) as f:
+                    path = os.path.join(SNAPSHOT_DIR, f.read().strip())
+                if _snapshot is None or _snapshot.path != path:
+                    # Atomic swap: in-flight queries keep the old object (and its mapping) alive
+                    _snapshot = RestaurantSnapshot(path)
+                    logger.info(f"Search snapshot {_snapshot.version} mapped ({_snapshot.size} rows)")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Snapshot Load Error: {e}")
+
+    snap = _snapshot
+    if snap and time.time() - snap.created_at <= SNAPSHOT_MAX_AGE_SECONDS:
+        return snap
+    return None
+
+# --- ADAPTIVE SEARCH RADIUS ---
+# Start tight and widen in rings until SEARCH_TARGET_RESULTS candidates are in range.
+# Our DB is read once at the outer ring (one round trip) and trimmed per ring locally;
+# each Google ring is its own places_cache entry, so repeat searches reuse inner rings.
+SEARCH_RADIUS_RINGS_MILES = [5.0, 15.0, 30.0, 50.0]
+SEARCH_TARGET_RESULTS = 15
+DEFAULT_SEARCH_RADIUS_MILES = 30.0
+METERS_PER_MILE = 1609.34
+
+def google_bias_radius(radius_miles: float) -> float:
+    """Ring radius -> Places bias radius. Up to 30 mi this is the classic <=30 km bias
+    (the 30 mi ring shares the pre-adaptive cache entry); beyond that, the full ring (tiled)."""
+    meters = radius_miles * METERS_PER_MILE
+    if radius_miles <= DEFAULT_SEARCH_RADIUS_MILES:
+        return min(meters, PLACES_BIAS_RADIUS_METERS)
+    return meters
+
+def fetch_db_candidates(search: SearchRequest, user_lat: float, user_lon: float, radius_miles: float) -> List[dict]:
+    """Analyzed restaurants in range: snapshot -> in-process index -> RPC"""
+    db_results = []
+    snapshot = current_snapshot()
+    if snapshot:
+        db_results = snapshot.query(
+            user_lat, user_lon, radius_miles, search.query,
+            search.filter_dedicated_gf, search.filter_dedicated_fryer, search.filter_gf_menu
+        )
+    elif spatial_index.is_ready():
+        db_results = spatial_index.query(
+            user_lat, user_lon, radius_miles, search.query,
+            search.filter_dedicated_gf, search.filter_dedicated_fryer, search.filter_gf_menu
+        )
+    else:
+        # Index cold or stale -> the RPC
+        try:
+            rpc_params = {
+                "user_lat": user_lat,
+                "user_lon": user_lon,
+                "search_query": search.query,
+                "radius_miles": radius_miles, # distance cap
+                # --- PARAMS for premium filters ---
+                "filter_dedicated_gf": search.filter_dedicated_gf,
+                "filter_dedicated_fryer": search.filter_dedicated_fryer,
+                "filter_gf_menu": search.filter_gf_menu
+            }
+            db_resp = supabase.rpc("search_nearby_restaurants", rpc_params).execute()
+            if db_resp.data:
+                db_results = db_resp.data
+        except Exception as e:
+            logger.error(f"DB Search Error: {e}")
+    return db_results
+
+# --- FILTER-AWARE QUERY PLANNER ---
+# Premium flags only ever come from our DB, so with a filter on, a Google-only place is
+# guaranteed to be dropped. Google still runs: its retrieval is semantic ("brunch" finds a
+# bakery), while the DB candidates only match names/types lexically. The filters are pushed
+# into the hydrate query, and Google-only places don't count toward filling a radius ring.
+# Since those places can't fill a ring, a filtered search gets a smaller Places budget: once it
+# is spent, wider rings are filled from our DB alone (read once at the outer ring, so free).
+FILTERED_SEARCH_MAX_CALLS = 2
+PREMIUM_FILTER_COLUMNS = {
+    "filter_dedicated_gf": "is_dedicated_gluten_free",
+    "filter_dedicated_fryer": "has_dedicated_fryer",
+    "filter_gf_menu": "has_gf_menu",
+}
+
+planner_stats = {"searches": 0, "filtered_searches": 0, "db_only_rings": 0,
+                 "hydrates_narrowed": 0, "hydrate_ids_avoided": 0}
+
+_planner_lock = threading.Lock()
+
+def _count_planner(stat: str, n: int = 1):
+    with _planner_lock:
+        planner_stats[stat] += n
+
+def plan_search(search: SearchRequest) -> dict:
+    hydrate_filters = {col: True for field, col in PREMIUM_FILTER_COLUMNS.items() if getattr(search, field)}
+    filtered = bool(hydrate_filters)
+    _count_planner("searches")
+    if filtered:
+        _count_planner("filtered_searches")
+    return {
+        "filtered": filtered,
+        "hydrate_filters": hydrate_filters,
+        "max_places_calls": FILTERED_SEARCH_MAX_CALLS if filtered else GOOGLE_SEARCH_MAX_CALLS,
+    }
+
+def fetch_search_candidates(search: SearchRequest, location: Optional[str], user_lat, user_lon, plan: dict):
+    """Returns (google_data, db_results, radius_miles). No coordinates -> one text search, no cap."""
+    if not (user_lat and user_lon):
+        return fetch_google_search(search.query, location, user_lat, user_lon), [], None
+
+    filtered = plan["filtered"]
+    db_all = fetch_db_candidates(search, user_lat, user_lon, SEARCH_RADIUS_RINGS_MILES[-1])
+    google_places = OrderedDict()
+    google_errors = []
+    # Every ring draws on one cap: the Places budget is per user search, not per ring
+    _count_places("searches")
+    budget = CallBudget(plan["max_places_calls"])
+
+    for radius in SEARCH_RADIUS_RINGS_MILES:
+        if budget.remaining > 0:
+            data = fetch_google_search(search.query, location, user_lat, user_lon,
+                                       radius_meters=google_bias_radius(radius), budget=budget)
+            if "places" in data:
+                for p in data["places"]:
+                    if p.get("id"): google_places.setdefault(p["id"], p)
+            else:
+                google_errors.append(data)
+        else:
+            _count_planner("db_only_rings")
+
+        in_range = {r["place_id"] for r in db_all if (r.get("dist_miles") or 0) <= radius}
+        if not filtered:
+            # Google-only places can't pass a premium filter, so they only count without one
+            places = list(google_places.values())
+            distances, within = geo_filter(
+                user_lat, user_lon,
+                [p.get("location", {}).get("latitude") for p in places],
+                [p.get("location", {}).get("longitude") for p in places],
+                radius,
+            )
+            in_range.update(places[i]["id"] for i in within)
+        if len(in_range) >= SEARCH_TARGET_RESULTS or (budget.remaining <= 0 and not filtered):
+            break
+
+    if budget.remaining <= 0:
+        _count_places("capped_searches")
+    db_results = [r for r in db_all if (r.get("dist_miles") or 0) <= radius]
+    if not google_places and google_errors:
+        return google_errors[0], db_results, radius
+    return {"places": list(google_places.values())}, db_results, radius
+
+# --- REVIEW FULL-TEXT INDEX ---
+# BM25 over what we already store per restaurant: Google review texts (restaurant_reviews;
+# `migrate-legacy-reviews` moves pre-split inline blobs there), community comments
+# (user_reviews) and the AI summary, one document per place. Built in a background thread at
+# startup and fully rebuilt every few hours; get_reviews writes update a place's document as
+# they happen. search_mode="reviews" ranks places by it within the geo radius, so "dedicated
+# fryer" or "got sick" never scans rows or calls Google. Until the first build finishes,
+# the same search matches the in-range AI summaries instead (summary_text_hits).
+REVIEW_INDEX_PAGE_SIZE = 1000
+REVIEW_INDEX_FULL_RELOAD_SECONDS = 6 * 3600
+REVIEW_SEARCH_RADIUS_MILES = SEARCH_RADIUS_RINGS_MILES[-1]
+REVIEW_SEARCH_LIMIT = 50
+BM25_K1 = 1.2
+BM25_B = 0.75
+REVIEW_INDEX_STOPWORDS = {"a", "an", "and", "are", "at", "be", "but", "for", "i", "in", "is", "it",
+                          "of", "on", "or", "so", "that", "the", "this", "to", "was", "we", "with"}
+
+def review_index_terms(text: Optional[str]) -> List[str]:
+    """Lowercase word tokens, stopwords dropped, trailing plural 's' folded ("fryers" -> "fryer")"""
+    words = re.findall(r"[a-z0-9]+", (text or "").lower().replace("'", "").replace("\u2019", ""))
+    return [w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+            for w in words if w not in REVIEW_INDEX_STOPWORDS]
+
+def review_texts(reviews: List[dict]) -> List[str]:
+    """Texts worth indexing from Google / formatted community reviews"""
+    texts = []
+    for r in reviews:
+        text = COMMUNITY_TAG_REGEX.sub("", r.get("text") or "")
+        if text and text != "No specific comment.":
+            texts.append(text)
+    return texts
+
+def _iter_table_pages(table: str, columns: str, order: List[str]):
+    """Range-paged full scan. `order` must be a unique key, or rows can repeat/vanish across pages."""
+    page = 0
+    while True:
+        query = supabase.table(table).select(columns)
+        for column in order:
+            query = query.order(column)
+        resp = query.range(page * REVIEW_INDEX_PAGE_SIZE, (page + 1) * REVIEW_INDEX_PAGE_SIZE - 1)\
+            .execute()
+        rows = resp.data or []
+        yield from rows
+        if len(rows) < REVIEW_INDEX_PAGE_SIZE: break
+        page += 1
+
+class ReviewTextIndex:
+    def __init__(self):
+        self.postings = {}     # term -> {place_id: term frequency}
+        self.docs = {}         # place_id -> {term: term frequency}
+        self.doc_len = {}      # place_id -> number of terms
+        self.total_len = 0
+        self.loaded_at = None
+        self._pending = None   # place_id -> texts written while a reload is running
+        self._loading = False
+        self._lock = threading.Lock()
+
+    def _remove(self, pid: str):
+        old = self.docs.pop(pid, None)
+        if not old: return
+        for term in old:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(pid, None)
+                if not posting: del self.postings[term]
+        self.total_len -= self.doc_len.pop(pid, 0)
+
+    def _put(self, pid: str, texts: List[str]):
+        self._remove(pid)
+        tf = {}
+        for text in texts:
+            for term in review_index_terms(text):
+                tf[term] = tf.get(term, 0) + 1
+        if not tf: return
+        self.docs[pid] = tf
+        self.doc_len[pid] = length = sum(tf.values())
+        self.total_len += length
+        for term, n in tf.items():
+            self.postings.setdefault(term, {})[pid] = n
+
+    def put(self, place_id: str, reviews: List[dict], ai_summary: Optional[str]):
+        """Replaces one place's document (Google + community reviews + summary)"""
+        texts = review_texts(reviews) + ([ai_summary] if ai_summary else [])
+        with self._lock:
+            self._put(place_id, texts)
+            if self._pending is not None:
+                self._pending[place_id] = texts
+
+    def load(self):
+        """Rebuilds from the DB into fresh structures, then swaps them in"""
+        with self._lock:
+            if self._loading: return
+            self._loading, self._pending = True, {}
+        try:
+            started = time.perf_counter()
+            texts = {}
+            for row in _iter_table_pages("restaurant_reviews", "place_id, review", ["place_id", "position"]):
+                texts.setdefault(row["place_id"], []).extend(review_texts([row.get("review") or {}]))
+            for row in _iter_table_pages("user_reviews", "place_id, comment", ["id"]):
+                if row.get("comment"):
+                    texts.setdefault(row["place_id"], []).append(row["comment"])
+            for row in _iter_table_pages("restaurants", "place_id, ai_summary", ["place_id"]):
+                if row.get("ai_summary"):
+                    texts.setdefault(row["place_id"], []).append(row["ai_summary"])
+
+            fresh = ReviewTextIndex()
+            for pid, place_texts in texts.items():
+                fresh._put(pid, place_texts)
+            with self._lock:
+                for pid, place_texts in self._pending.items():
+                    fresh._put(pid, place_texts)   # Writes that landed mid-load win
+                self.postings, self.docs, self.doc_len, self.total_len = \
+                    fresh.postings, fresh.docs, fresh.doc_len, fresh.total_len
+                self.loaded_at = time.monotonic()
+            logger.info(f"Review text index loaded: {len(self.docs)} places, {len(self.postings)} terms "
+                        f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+        except Exception as e:
+            logger.error(f"Review Text Index Load Error: {e}")
+        finally:
+            with self._lock:
+                self._loading, self._pending = False, None
+
+    def load_in_background(self):
+        threading.Thread(target=self.load, daemon=True).start()
+
+    def is_ready(self) -> bool:
+        """Loaded at least once; schedules the periodic rebuild when due"""
+        if self.loaded_at is None: return False
+        if time.monotonic() - self.loaded_at > REVIEW_INDEX_FULL_RELOAD_SECONDS and not self._loading:
+            self.load_in_background()
+        return True
+
+    def search(self, query: str, limit: int = REVIEW_SEARCH_LIMIT, allowed=None) -> List[tuple]:
+        """[(place_id, bm25, matched_terms)] best first; `allowed` optionally restricts place_ids"""
+        terms = list(dict.fromkeys(review_index_terms(query)))
+        with self._lock:
+            n_docs = len(self.docs)
+            if not terms or not n_docs: return []
+            avg_len = self.total_len / n_docs
+            scores, matched = {}, {}
+            for term in terms:
+                posting = self.postings.get(term)
+                if not posting: continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for pid, tf in posting.items():
+                    if allowed is not None and pid not in allowed: continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[pid] / avg_len)
+                    scores[pid] = scores.get(pid, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    matched.setdefault(pid, []).append(term)
+        best = heapq.nlargest(limit, scores.items(), key=lambda kv: kv[1])
+        return [(pid, score, matched[pid]) for pid, score in best]
+
+review_text_index = ReviewTextIndex()
+
+@app.on_event("startup")
+def load_review_text_index():
+    review_text_index.load_in_background()
+
+def summary_text_hits(query: str, rows: dict, limit: int = REVIEW_SEARCH_LIMIT) -> List[tuple]:
+    """Stand-in while the index warms: share of the query terms found in each AI summary"""
+    terms = list(dict.fromkeys(review_index_terms(query)))
+    if not terms: return []
+    hits = []
+    for pid, row in rows.items():
+        words = set(review_index_terms(row.get("ai_summary")))
+        matched = [t for t in terms if t in words]
+        if matched:
+            hits.append((pid, len(matched) / len(terms), matched))
+    return heapq.nlargest(limit, hits, key=lambda h: h[1])
+
+def search_review_text(search: SearchRequest, lat: float, lng: float, open_at) -> dict:
+    # Everything analyzed in range (the query matches review text here, not names)
+    in_range = fetch_db_candidates(search.model_copy(update={"query": ""}), lat, lng, REVIEW_SEARCH_RADIUS_MILES)
+    nearby = {r["place_id"]: r for r in in_range}
+    warming = not review_text_index.is_ready()
+    if warming:
+        hits = summary_text_hits(search.query, nearby)
+    else:
+        hits = review_text_index.search(search.query, allowed=nearby)
+
+    results = []
+    for pid, score, terms in hits:
+        r = nearby[pid]
+        results.append({
+            "name": r.get("name"),
+            "address": r.get("address"),
+            "city": r.get("city") or extract_city(r.get("address")),
+            "rating": float(r.get("rating") or 0),
+            "place_id": pid,
+            "location": {"lat": r.get("lat"), "lng": r.get("lng")},
+            "distance_miles": round(r["dist_miles"], 2),
+            "google_types": r.get("google_types"),
+            "price_level": None,
+            "ai_safety_score": float(r["ai_safety_score"]) if r.get("ai_safety_score") else None,
+            "ai_summary": r.get("ai_summary"),
+            "wise_bites_score": float(r["wise_bites_score"]) if r.get("wise_bites_score") else None,
+            "relevant_count": (r.get("relevant_count") or 0) + (r.get("community_review_count") or 0),
+            "is_dedicated_gluten_free": r.get("is_dedicated_gluten_free", False),
+            "has_dedicated_fryer": r.get("has_dedicated_fryer", False),
+            "has_gf_menu": r.get("has_gf_menu", False),
+            "hours_schedule": r.get("hours_schedule"),
+            "hours_intervals": r.get("hours_intervals"),
+            "time_zone": r.get("time_zone"),
+            "is_cached": True,
+            "source": "Summaries" if warming else "Reviews",
+            "text_score": round(score, 3),
+            "matched_terms": terms,
+        })
+    results = apply_hours_filters(results, search, open_at)
+    if search.sort_by and search.sort_by != "relevant":
+        sort_search_results(results, search.sort_by, True)   # Default keeps the BM25 order
+    return {"results": results, "radius_miles": REVIEW_SEARCH_RADIUS_MILES}
 
 @app.post("/api/search")
-def search_restaurants(search: SearchRequest):
+def search_restaurants(search: SearchRequest, http_response: Response, if_none_match: Optional[str] = Header(None),
+                       x_profile_token: Optional[str] = Header(None)):
+    record_inbound("search", search)
+    with profile_request("search", x_profile_token, http_response):
+        return handle_search(search, http_response, if_none_match)
+
+def handle_search(search: SearchRequest, http_response: Response, if_none_match: Optional[str]):
     # --- NEW: PREMIUM GATE ---
     if search.user_id:
         is_allowed = check_and_update_limit(search.user_id)
@@ -440,47 +3182,43 @@ def search_restaurants(search: SearchRequest):
     if not search_location and not (user_lat and user_lon):
          raise HTTPException(status_code=400, detail="Must provide location or address")
 
-    # A. Fetch from Google Places API
-    google_data = fetch_google_search(search.query, search_location, user_lat, user_lon)
-    
-    # B. Fetch from Supabase (Existing "Hidden Gems" or Safe Spots)
-    # We call the RPC function we just created
-    db_results = []
-    if user_lat and user_lon:
-        try:
-            # print("Calling Supabase RPC for nearby restaurants...")
-            rpc_params = {
-                "user_lat": user_lat,
-                "user_lon": user_lon,
-                "search_query": search.query,
-                "radius_miles": 30.0, # distance cap
-                # --- PARAMS for premium filters ---
-                "filter_dedicated_gf": search.filter_dedicated_gf,
-                "filter_dedicated_fryer": search.filter_dedicated_fryer,
-                "filter_gf_menu": search.filter_gf_menu
-            }
-            db_resp = supabase.rpc("search_nearby_restaurants", rpc_params).execute()
-            if db_resp.data:
-                db_results = db_resp.data
-            # print(f"Supabase returned {len(db_results)} results.")
-        except Exception as e:
-            logger.error(f"DB Search Error: {e}")
+    open_at = parse_open_at(search.open_at)
+
+    if search.search_mode == "reviews":
+        if not (user_lat and user_lon):
+            raise HTTPException(status_code=400, detail="Review search needs a location that can be geocoded")
+        return respond_with_etag(search_review_text(search, user_lat, user_lon, open_at), http_response, if_none_match)
+
+    cache_key = None if search.open_now or search.open_at else \
+        search_cache_key(search, user_lat, user_lon, search_location)
+    cached_body = cache_key and get_cached_search_response(cache_key, user_lat, user_lon, search.sort_by)
+    if cached_body:
+        return respond_with_etag(cached_body, http_response, if_none_match)
+
+    # A + B. Google Places + our DB, expanding the radius in rings until there's enough to show
+    plan = plan_search(search)
+    google_data, db_results, search_radius = fetch_search_candidates(search, search_location, user_lat, user_lon, plan)
 
     # --- 2. MERGE RESULTS ---
     combined_results = {} # Use a dict keyed by place_id to deduplicate
 
     # Process Google Results First
     if "places" in google_data:
-        for place in google_data["places"]:
+        places = [p for p in google_data["places"] if p.get("id")]
+        # Distances + radius cap for every place in one batched call
+        distances, within_cap = geo_filter(
+            user_lat, user_lon,
+            [p.get("location", {}).get("latitude") for p in places],
+            [p.get("location", {}).get("longitude") for p in places],
+            search_radius,
+        )
+        for i in sorted(within_cap):
+            place = places[i]
             pid = place.get("id")
-            if not pid: continue
             
             lat = place.get("location", {}).get("latitude")
             lng = place.get("location", {}).get("longitude")
-            dist = calculate_distance(user_lat, user_lon, lat, lng) if user_lat else None
-            
-            # Distance Cap
-            if dist is not None and dist > 30.0: continue
+            dist = distances[i]
 
             address_str = place.get("formattedAddress", "")
             raw_hours = place.get("regularOpeningHours", {}).get("weekdayDescriptions", [])
@@ -499,6 +3237,8 @@ def search_restaurants(search: SearchRequest):
                 "location": {"lat": lat, "lng": lng},
                 "distance_miles": round(dist, 2) if dist else None,
                 "hours_schedule": cleaned_hours,
+                "hours_intervals": place.get("hoursIntervals"),
+                "time_zone": place.get("timeZone"),
                 "google_types": google_types,   # <--- NEW
                 "price_level": price_level,     # <--- NEW
                 "ai_safety_score": None, 
@@ -556,6 +3296,10 @@ def search_restaurants(search: SearchRequest):
             entry["has_dedicated_fryer"] = has_fryer
             entry["has_gf_menu"] = has_menu
             entry["hours_schedule"] = db_hours if db_hours else entry["hours_schedule"]
+            if db_hours:
+                entry["hours_intervals"] = db_r.get("hours_intervals")
+            if db_r.get("time_zone"):
+                entry["time_zone"] = db_r["time_zone"]
             entry["source"] = "Hybrid (Merged)"
         else:
             db_lat = db_r.get('lat', 0)
@@ -583,6 +3327,8 @@ def search_restaurants(search: SearchRequest):
                 "has_dedicated_fryer": has_fryer,   
                 "has_gf_menu": has_menu,
                 "hours_schedule": db_hours,
+                "hours_intervals": db_r.get("hours_intervals"),
+                "time_zone": db_r.get("time_zone"),
                 "is_cached": is_fresh,
                 "source": "Supabase"
             }
@@ -600,7 +3346,14 @@ def search_restaurants(search: SearchRequest):
     
     if uncached_ids:
         try:
-            response = supabase.table("restaurants").select("*").in_("place_id", uncached_ids).execute()
+            query = supabase.table("restaurants").select(SEARCH_HYDRATE_COLUMNS).in_("place_id", uncached_ids)
+            for col, value in plan["hydrate_filters"].items():
+                query = query.eq(col, value)  # Rows that can't pass the filters never leave the DB
+            response = query.execute()
+            if plan["filtered"]:
+                _count_planner("hydrates_narrowed")
+                _count_planner("hydrate_ids_avoided", len(uncached_ids) - len(response.data))
+            logger.info(f"Hydrate: {len(response.data)} rows, {payload_bytes(response.data)} bytes")
             cache_map = {row['place_id']: row for row in response.data}
 
             for r in final_list:
@@ -658,10 +3411,13 @@ def search_restaurants(search: SearchRequest):
                     db_missing_price = not cached.get("price_level")
                     db_missing_loc = (cached.get("lat") is None or cached.get("lng") is None)
                     db_missing_hours = not cached.get("hours_schedule")
+                    db_missing_hours_index = cached.get("hours_intervals") is None and bool(r.get("hours_schedule"))
+                    db_missing_time_zone = not cached.get("time_zone") and bool(r.get("time_zone"))
                     current_rating = cached.get("rating")
                     db_missing_rating = (current_rating is None or float(current_rating) == 0)
                     
-                    if (db_missing_types or db_missing_price or db_missing_loc or db_missing_hours or db_missing_rating):
+                    if (db_missing_types or db_missing_price or db_missing_loc or db_missing_hours or db_missing_rating
+                            or db_missing_hours_index or db_missing_time_zone):
                         try:
                             update_payload = {}
                             
@@ -678,6 +3434,13 @@ def search_restaurants(search: SearchRequest):
 
                             if r.get("hours_schedule"): 
                                 update_payload["hours_schedule"] = r["hours_schedule"]
+                                hours_intervals = r.get("hours_intervals")
+                                if hours_intervals is None:
+                                    hours_intervals = parse_hours_schedule(r["hours_schedule"])
+                                update_payload["hours_intervals"] = hours_intervals
+
+                            if r.get("time_zone"):
+                                update_payload["time_zone"] = r["time_zone"]
 
                             if r.get("rating") and db_missing_rating:
                                 update_payload["rating"] = r["rating"]
@@ -706,197 +3469,536 @@ def search_restaurants(search: SearchRequest):
 
     if search.filter_gf_menu:
         final_list = [r for r in final_list if r.get("has_gf_menu") is True]
+
+    final_list = apply_hours_filters(final_list, search, open_at)
     
     # =========================================================
     # --- ADVANCED SORTING LOGIC ---
     # =========================================================
-    sort_mode = search.sort_by or "relevant"
+    sort_search_results(final_list, search.sort_by, bool(user_lat))
 
-    def sort_relevant(x):
-        # 1. Verified Scores First (High -> Low)
-        # 2. Distance Second (Low -> High)
-        wb = x.get("wise_bites_score") or 0
-        dist = x.get("distance_miles") or 9999
-        
-        # Tuple Sort: (HasNoScore?, -Score, Distance)
-        # If WB=8.0: (0, -8.0, dist) -> Smaller 1st item floats to top
-        # If WB=None: (1, 0, dist) -> Larger 1st item sinks
-        has_no_score = 0 if wb > 0 else 1
-        return (has_no_score, -wb, dist)
-
-    def sort_top_rated(x):
-        # 1. Verified Scores First (High -> Low)
-        # 2. Google Ratings Second (High -> Low)
-        wb = x.get("wise_bites_score") or 0
-        rating = x.get("rating") or 0
-        
-        # Verified always beats Unverified.
-        has_no_score = 0 if wb > 0 else 1
-        return (has_no_score, -wb, -rating)
+    # Start analyzing what will be on screen first before the cards ask for it
+    schedule_prefetch(final_list, search.user_id)
 
-    def sort_distance(x):
-        # Strict Distance (Low -> High)
-        return x.get("distance_miles") or 9999
+    response_body = {"results": final_list, "radius_miles": search_radius}
+    if cache_key:
+        store_search_response(cache_key, response_body)
+    return respond_with_etag(response_body, http_response, if_none_match)
 
-    def sort_reviews(x):
-        # Most Reviewed (High -> Low)
-        return -(x.get("relevant_count") or 0)
+# --- COMMUNITY-ONLY RESCORE ---
+RESUMMARY_LOW_AI_SCORE = 5.0  # A "felt safe" report below this contradicts the current summary
 
-    # APPLY SORT
-    if sort_mode == "top_rated":
-        final_list.sort(key=sort_top_rated) 
-    elif sort_mode == "distance":
-        final_list.sort(key=sort_distance)
-    elif sort_mode == "reviews":
-        final_list.sort(key=sort_reviews)
-    else:
-        # Default / Relevant
-        if user_lat: 
-            final_list.sort(key=sort_relevant)
-        else: 
-            # Fallback if no location data available
-            final_list.sort(key=lambda x: x.get("rating", 0), reverse=True)
+def community_changes_safety_picture(new_reports: List[dict], record: dict) -> bool:
+    """Whether community reports posted since the last analysis would change its summary"""
+    ai_score = float(record.get("ai_safety_score") or 0)
+    for r in new_reports:
+        if r.get("did_feel_safe") is False:
+            return True  # Any new unsafe report
+        if r.get("is_dedicated_gluten_free") and not record.get("is_dedicated_gluten_free"):
+            return True
+        if r.get("did_feel_safe") is True and ai_score < RESUMMARY_LOW_AI_SCORE:
+            return True
+    return False
 
-    return {"results": final_list}
+# --- ANALYSIS ADMISSION CONTROL ---
+# A full analysis (SerpApi + a 70b completion) holds a worker thread for seconds. At most
+# ANALYSIS_MAX_CONCURRENCY run per process; the rest wait in a priority queue (lower = sooner).
+# The wait queue is bounded too, because waiters also hold threads from the same pool that
+# serves /api/search. Work that can't get a slot in time is shed: callers get the stale
+# analysis when one exists, otherwise a 503 with Retry-After.
+ANALYSIS_MAX_CONCURRENCY = int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "4"))
+ANALYSIS_MAX_WAITING = int(os.getenv("ANALYSIS_MAX_WAITING", "16"))
+ANALYSIS_RETRY_AFTER_SECONDS = 10
 
-@app.post("/api/reviews")
-def get_reviews(req: ReviewRequest):
-    
-    def format_community_reviews(place_id):
-        """Fetches and formats WiseBites reviews for this place."""
-        formatted = []
-        wb_safe_free = 0
-        wb_safe_premium = 0
-        wb_unsafe_free = 0
-        wb_unsafe_premium = 0
-        wb_dedicated_count = 0
-        wb_avg = 0
-        total_count = 0
-        
+PRIORITY_PREMIUM, PRIORITY_DETAIL, PRIORITY_CARD, PRIORITY_PREFETCH = 0, 1, 2, 3
+PRIORITY_NAMES = {0: "premium", 1: "detail", 2: "card", 3: "prefetch"}
+ANALYSIS_CONTEXT_PRIORITY = {"detail": PRIORITY_DETAIL, "card": PRIORITY_CARD, "prefetch": PRIORITY_PREFETCH}
+ANALYSIS_MAX_WAIT_SECONDS = {PRIORITY_PREMIUM: 30.0, PRIORITY_DETAIL: 30.0, PRIORITY_CARD: 10.0, PRIORITY_PREFETCH: 0.0}
+ANALYSIS_SHED_DEPTH = {PRIORITY_CARD: 8}  # Card loads don't even queue behind this many waiters
+
+premium_cache = Cache("premium", 300, shared=False)
+
+def is_premium_user(user_id: Optional[str]) -> bool:
+    # The user_id is the client's claim, as with the search limit; it only buys queue
+    # position, never data. Verifying the Supabase JWT instead would close that gap.
+    if not user_id: return False
+    cached = premium_cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+    try:
+        resp = supabase.table("profiles").select("is_premium").eq("id", user_id).limit(1).execute()
+        premium = bool(resp.data and resp.data[0].get("is_premium"))
+    except Exception as e:
+        logger.error(f"Premium Lookup Error: {e}")
+        return False
+    premium_cache.set(user_id, premium)
+    return premium
+
+def analysis_priority(req: ReviewRequest) -> int:
+    priority = ANALYSIS_CONTEXT_PRIORITY.get(req.context or "card", PRIORITY_CARD)
+    # Premium users jump ahead, but their speculative prefetches don't
+    if priority != PRIORITY_PREFETCH and is_premium_user(req.user_id):
+        return PRIORITY_PREMIUM
+    return priority
+
+class AnalysisGate:
+    def __init__(self, slots: int, max_waiting: int):
+        self.slots = slots
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.attached = 0    # Callers blocked on another caller's analysis (see try_attach)
+        self._waiting = []   # heap of (priority, seq)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.stats = {name: {"admitted": 0, "shed": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+                      for name in PRIORITY_NAMES.values()}
+
+    def acquire(self, priority: int) -> bool:
+        """Blocks until a slot is free and this is the most urgent waiter; False = shed"""
+        stats = self.stats[PRIORITY_NAMES[priority]]
+        started = time.perf_counter()
+        with self._cond:
+            if self.active < self.slots and not self._waiting:
+                self.active += 1
+                stats["admitted"] += 1
+                return True
+
+            max_wait = ANALYSIS_MAX_WAIT_SECONDS[priority]
+            if (max_wait <= 0 or len(self._waiting) + self.attached >= self.max_waiting
+                    or len(self._waiting) >= ANALYSIS_SHED_DEPTH.get(priority, self.max_waiting)):
+                stats["shed"] += 1
+                return False
+
+            self._seq += 1
+            ticket = (priority, self._seq)
+            heapq.heappush(self._waiting, ticket)
+            deadline = started + max_wait
+            while not (self.active < self.slots and self._waiting[0] == ticket):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    stats["shed"] += 1
+                    self._cond.notify_all()  # The head may have changed
+                    return False
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._waiting)
+            self.active += 1
+            waited_ms = (time.perf_counter() - started) * 1000
+            stats["admitted"] += 1
+            stats["wait_ms_total"] += waited_ms
+            stats["wait_ms_max"] = max(stats["wait_ms_max"], waited_ms)
+            self._cond.notify_all()  # Another slot may still be free for the next waiter
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def try_attach(self) -> bool:
+        """An attacher holds a worker thread just like a queued caller, so both share max_waiting"""
+        with self._cond:
+            if len(self._waiting) + self.attached >= self.max_waiting:
+                return False
+            self.attached += 1
+            return True
+
+    def detach(self):
+        with self._cond:
+            self.attached -= 1
+
+    def has_idle_slot(self) -> bool:
+        with self._cond:
+            return self.active < self.slots and not self._waiting
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self._waiting:
+                depth[PRIORITY_NAMES[priority]] += 1
+            return {
+                "slots": self.slots,
+                "active": self.active,
+                "queue_depth": len(self._waiting),
+                "attached": self.attached,
+                "queue_depth_by_priority": depth,
+                "by_priority": {
+                    name: {**s, "wait_ms_avg": round(s["wait_ms_total"] / s["admitted"], 1) if s["admitted"] else None}
+                    for name, s in self.stats.items()
+                },
+            }
+
+analysis_gate = AnalysisGate(ANALYSIS_MAX_CONCURRENCY, ANALYSIS_MAX_WAITING)
+
+# --- IN-FLIGHT ANALYSES ---
+# One full analysis per place at a time (per process). The first caller (an endpoint or a
+# search prefetch) leads; anyone asking for the same place meanwhile attaches to its Future
+# and gets the same payload instead of paying SerpApi + Groq again.
+ANALYSIS_ATTACH_TIMEOUT_SECONDS = 45
+
+_inflight_analyses = {}   # place_id -> Future (payload, or None if the leader gave up)
+_inflight_lock = threading.Lock()
+inflight_stats = {"led": 0, "attached": 0, "attach_timeouts": 0, "attach_shed": 0, "reclaims": 0}
+
+def claim_analysis(place_id: str):
+    """(future, is_leader): the leader must settle_analysis() when done, whatever happens"""
+    with _inflight_lock:
+        future = _inflight_analyses.get(place_id)
+        if future is not None:
+            inflight_stats["attached"] += 1
+            return future, False
+        future = Future()
+        _inflight_analyses[place_id] = future
+        inflight_stats["led"] += 1
+        return future, True
+
+def settle_analysis(place_id: str, future: Future, payload: Optional[dict]):
+    with _inflight_lock:
+        if _inflight_analyses.get(place_id) is future:
+            del _inflight_analyses[place_id]
+    future.set_result(payload)
+
+def await_analysis(future: Future) -> Optional[dict]:
+    try:
+        return future.result(timeout=ANALYSIS_ATTACH_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        inflight_stats["attach_timeouts"] += 1
+        return None
+
+ANALYSIS_CLAIM_ATTEMPTS = 3
+
+def lead_or_attach(req: ReviewRequest, record: Optional[dict]):
+    """
+    ("lead", future, record): run the analysis and settle_analysis(future) afterwards
+    ("done", payload, record): an attached analysis (or a now-fresh row) answered
+    ("shed", None, record):    the leader is still running past the attach timeout, or too many
+                               callers are already blocked (attachers count against the gate)
+    A leader that gave up (a shed prefetch, or one that found the row fresh) settles None;
+    its waiters then re-read the row and claim again at their own priority.
+    """
+    for _ in range(ANALYSIS_CLAIM_ATTEMPTS):
+        future, leader = claim_analysis(req.place_id)
+        if leader:
+            return "lead", future, record
+        if not analysis_gate.try_attach():
+            inflight_stats["attach_shed"] += 1
+            return "shed", None, record
         try:
-            # Fetch live from user_reviews table
-            resp = supabase.table("user_reviews")\
-                .select("*, profiles(dietary_preference, is_premium)")\
-                .eq("place_id", place_id)\
-                .execute()
-                
-            wb_data = resp.data or []
-            total_count = len(wb_data)
-            
-            if wb_data:
-                wb_ratings = [r['rating'] for r in wb_data if r.get('rating')]
-                if wb_ratings:
-                    wb_avg = sum(wb_ratings) / len(wb_ratings)
-                
-                wb_safe = sum(1 for r in wb_data if r.get('did_feel_safe') is True)
-                wb_unsafe = sum(1 for r in wb_data if r.get('did_feel_safe') is False)
-
-                for r in wb_data:
-                    # Extract Profile Data safely
-                    user_profile = r.get('profiles') or {}
-                    is_premium = user_profile.get('is_premium', False)
-                    sensitivity = user_profile.get('dietary_preference', 'Unknown')
-                    
-                    is_safe = r.get('did_feel_safe')
-                    is_dedicated = r.get('is_dedicated_gluten_free', False)
-
-                    # 1. Count Dedicated Tags
-                    if is_dedicated:
-                        wb_dedicated_count += 1
-
-                    # 2. Count Safe/Unsafe by Tier
-                    if is_safe is True:
-                        if is_premium:
-                            wb_safe_premium += 1
-                        else:
-                            wb_safe_free += 1
-                    elif is_safe is False:
-                        if is_premium:
-                            wb_unsafe_premium += 1
-                        else:
-                            wb_unsafe_free += 1
-
-                    # 3. Format for display
-                    safety_tag = "SAFE" if is_safe else "UNSAFE"
-                    comment = r.get('comment') or "No specific comment."
-                    badge_text = " [DEDICATED GF]" if is_dedicated else ""
-
-                    formatted.append({
-                        "source": "WiseBites Community",
-                        "text": f"[{safety_tag} REPORT]{badge_text} {comment}",
-                        "rating": r.get('rating', 0),
-                        "author": "WiseBites Member",
-                        "user_sensitivity": sensitivity,
-                        "date": r.get('created_at', "")[:10],
-                        "relevant": True,
-                        "is_dedicated_gluten_free": is_dedicated,
-                        "is_premium": is_premium
-                    })
+            payload = await_analysis(future)
+        finally:
+            analysis_gate.detach()
+        if payload:
+            return "done", payload, record
+        if not future.done():
+            return "shed", None, record
+        inflight_stats["reclaims"] += 1
+        record = read_review_record(req.place_id)
+        cached = cached_reviews_payload(req, record)
+        if cached:
+            return "done", cached, record
+    return "shed", None, record
+
+# --- REVIEW ANALYSIS PIPELINE ---
+# get_reviews and its streaming variant share these steps. The full refresh is a generator of
+# (event, data) pairs whose return value is the final payload; run_review_steps drains it.
+def community_review_relevance(row: dict) -> dict:
+    """Relevance stored on the user_reviews row, or computed in memory when it isn't scored yet"""
+    if row.get("relevance_score") is not None:
+        return {
+            "relevance_score": row["relevance_score"],
+            "matched_terms": row.get("matched_terms") or [],
+            "negated_terms": row.get("negated_terms") or [],
+        }
+    return score_review_relevance(row.get("comment") or "")
+
+def persist_community_relevance(rows: List[dict]) -> int:
+    """
+    Stores relevance on user_reviews rows that don't have it yet. Only the write paths call
+    this: the re-score that follows a new review (usually one row) and the
+    `score-community-relevance` backfill. Reads (GET /api/reviews included) never write.
+    """
+    written = 0
+    for row in rows:
+        if row.get("relevance_score") is not None or row.get("id") is None:
+            continue
+        try:
+            supabase.table("user_reviews").update(score_review_relevance(row.get("comment") or ""))\
+                .eq("id", row["id"]).execute()
+            written += 1
         except Exception as e:
-            logger.error(f"Error fetching community reviews: {e}")
+            logger.error(f"Community Relevance Write Error: {e}")
+            break  # Same failure for every row (e.g. the SCHEMA_DDL columns are missing)
+    return written
+
+def score_community_relevance(page_size: int = SCORE_RECOMPUTE_CHUNK):
+    """Backfill: relevance for every unscored user_reviews row (python api/index.py score-community-relevance)"""
+    scored, last_id = 0, None
+    while True:
+        q = supabase.table("user_reviews").select("id, comment, relevance_score")
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        rows = q.order("id").limit(page_size).execute().data or []
+        scored += persist_community_relevance(rows)
+        if len(rows) < page_size: break
+        last_id = rows[-1]["id"]
+    print(f"Scored {scored} community reviews")
+
+def format_community_reviews(place_id, persist_relevance: bool = False):
+    """Fetches and formats WiseBites reviews for this place."""
+    formatted = []
+    wb_safe_free = 0
+    wb_safe_premium = 0
+    wb_unsafe_free = 0
+    wb_unsafe_premium = 0
+    wb_dedicated_count = 0
+    wb_avg = 0
+    total_count = 0
+    
+    try:
+        # Fetch live from user_reviews table
+        resp = supabase.table("user_reviews")\
+            .select("*, profiles(dietary_preference, is_premium)")\
+            .eq("place_id", place_id)\
+            .execute()
             
-        return formatted, wb_avg, wb_safe_free, wb_safe_premium, wb_dedicated_count, wb_unsafe_free, wb_unsafe_premium, total_count
+        wb_data = resp.data or []
+        total_count = len(wb_data)
+        
+        if wb_data:
+            wb_avg, wb_safe_free, wb_safe_premium, wb_dedicated_count, wb_unsafe_free, wb_unsafe_premium = \
+                tally_community_reviews(wb_data)
+            if persist_relevance:
+                persist_community_relevance(wb_data)
+
+            for r in wb_data:
+                # Extract Profile Data safely
+                user_profile = r.get('profiles') or {}
+                is_premium = user_profile.get('is_premium', False)
+                sensitivity = user_profile.get('dietary_preference', 'Unknown')
+                
+                is_safe = r.get('did_feel_safe')
+                is_dedicated = r.get('is_dedicated_gluten_free', False)
+
+                # Format for display
+                safety_tag = "SAFE" if is_safe else "UNSAFE"
+                comment = r.get('comment') or "No specific comment."
+                badge_text = " [DEDICATED GF]" if is_dedicated else ""
+
+                formatted.append({
+                    **community_review_relevance(r),
+                    "source": "WiseBites Community",
+                    "text": f"[{safety_tag} REPORT]{badge_text} {comment}",
+                    "rating": r.get('rating', 0),
+                    "author": "WiseBites Member",
+                    "user_sensitivity": sensitivity,
+                    "date": r.get('created_at', "")[:10],
+                    "relevant": True,
+                    "is_dedicated_gluten_free": is_dedicated,
+                    "is_premium": is_premium,
+                    "did_feel_safe": is_safe,
+                    "created_at": r.get('created_at')
+                })
+    except Exception as e:
+        logger.error(f"Error fetching community reviews: {e}")
+        
+    return formatted, wb_avg, wb_safe_free, wb_safe_premium, wb_dedicated_count, wb_unsafe_free, wb_unsafe_premium, total_count
+
+REVIEW_STORE_RETRY_AFTER_SECONDS = 30
+
+def read_review_record(place_id: str) -> Optional[dict]:
+    """
+    The stored row, or None when the place was never analyzed. A failed read (outage, or a
+    column from SCHEMA_DDL that isn't there) raises a 503: it must not look like "not cached".
+    """
+    # The row is read either way: a refresh merges into the reviews it already has.
+    try:
+        response = supabase.table("restaurants").select(REVIEW_DETAIL_COLUMNS).eq("place_id", place_id).execute()
+    except Exception as e:
+        logger.error(f"Supabase Read Error: {e}")
+        raise HTTPException(status_code=503, detail="Restaurant data is temporarily unavailable.",
+                            headers={"Retry-After": str(REVIEW_STORE_RETRY_AFTER_SECONDS)})
+    return response.data[0] if response.data else None
+
+def wants_community_rescore(req: ReviewRequest, record: Optional[dict]) -> bool:
+    return bool(record and req.force_refresh and req.community_only and record.get("ai_safety_score") is not None)
+
+def rescore_from_community(req: ReviewRequest, record: dict) -> dict:
+    """
+    COMMUNITY-ONLY REFRESH (right after a user review)
+    The Google side can't have changed because of a WiseBites review: keep the stored analysis,
+    re-score with the live community tally, and only flag a re-summary when the new reports
+    change the safety picture. The next full read of this place picks the flag up.
+    """
+    wb_reviews, wb_avg, wb_safe_free, wb_safe_prem, wb_dedi, wb_unsafe_free, wb_unsafe_prem, wb_count = \
+        format_community_reviews(req.place_id, persist_relevance=True)  # Scores the review just submitted
+    google_count = int(record.get("relevant_count") or 0)
+    final_wb_score = calculate_wisebites_score(
+        record.get("ai_safety_score"),
+        record.get("average_safety_rating"),
+        google_count,
+        wb_avg, wb_safe_free, wb_safe_prem, wb_dedi, wb_unsafe_free, wb_unsafe_prem
+    )
+
+    analyzed_at = parse_timestamp(record.get("last_updated"))
+    new_reports = [r for r in wb_reviews
+                   if analyzed_at is None or (parse_timestamp(r.get("created_at")) or analyzed_at) > analyzed_at]
+    needs_resummary = bool(record.get("needs_resummary")) or community_changes_safety_picture(new_reports, record)
+
+    rescored = {
+        "wise_bites_score": final_wb_score,
+        "community_review_count": wb_count,
+        "needs_resummary": needs_resummary,
+    }
+    try:
+        supabase.table("restaurants").update(rescored).eq("place_id", req.place_id).execute()
+        spatial_index.apply_write(req.place_id, rescored)
+    except Exception as e:
+        logger.error(f"Supabase Rescore Error: {e}")
+    invalidate_search_cache(req.place_id, req.lat, req.lng)
+    stored_reviews = load_stored_reviews(req.place_id)
+    review_text_index.put(req.place_id, stored_reviews + wb_reviews, record.get("ai_summary"))
+
+    return {
+        "reviews": stored_reviews + wb_reviews,
+        "relevant_count": google_count + wb_count,
+        "average_safety_rating": record.get("average_safety_rating"),
+        "ai_safety_score": record.get("ai_safety_score", 0),
+        "wise_bites_score": final_wb_score,
+        "ai_summary": record.get("ai_summary", "No summary available."),
+        "is_dedicated_gluten_free": record.get("is_dedicated_gluten_free", False),
+        "last_updated": record.get("last_updated"),
+        "community_review_count": wb_count,
+        "resummary_queued": needs_resummary,
+        "source": "Cache (Google) + Live (WiseBites), re-scored"
+    }
+
+def record_is_fresh(record: dict) -> bool:
+    # A queued re-summary turns the next read into a full refresh
+    if record.get("needs_resummary"):
+        return False
+    last_updated = parse_timestamp(record.get("last_updated"))
+    return bool(last_updated and datetime.now(timezone.utc) - last_updated < timedelta(days=30))
+
+def cached_reviews_payload(req: ReviewRequest, record: Optional[dict], allow_stale: bool = False) -> Optional[dict]:
+    """
+    The fresh-cache response, or None when a full refresh is needed (always on force_refresh).
+    allow_stale serves whatever analysis the row holds (used when a refresh is shed).
+    """
+    if not record:
+        return None
+    if not allow_stale and (req.force_refresh or not record_is_fresh(record)):
+        return None
+
+    # A. Get Google Reviews from Cache (Pure)
+    cached_google_reviews = load_stored_reviews(req.place_id)
     
-    # 1. CHECK CACHE (Skip if force_refresh is True)
-    if not req.force_refresh:
-        try:
-            response = supabase.table("restaurants").select("*").eq("place_id", req.place_id).execute()
-            data = response.data
-            if data:
-                record = data[0]
-                last_updated = datetime.fromisoformat(record["last_updated"].replace('Z', '+00:00'))
-                if datetime.now(timezone.utc) - last_updated < timedelta(days=30): 
-                    # print("Returning Cached Data")
-
-                    # A. Get Google Reviews from Cache (Pure)
-                    cached_google_reviews = record["reviews"] or []
-                    
-                    # B. Fetch Community Reviews LIVE (Always Fresh)
-                    wb_reviews, wb_avg, wb_safe_free, wb_safe_prem, wb_dedi, wb_unsafe_free, wb_unsafe_prem, wb_count = format_community_reviews(req.place_id)
-                    
-                    # C. Combine for Frontend Display
-                    combined_reviews = cached_google_reviews + wb_reviews
-
-                    # Recalculate Total Count
-                    google_count = int(record.get("relevant_count") or 0)
-
-                    return {
-                        "reviews": combined_reviews, # Return BOTH
-                        "relevant_count": google_count + wb_count,
-                        "average_safety_rating": record["average_safety_rating"],
-                        "ai_safety_score": record.get("ai_safety_score", 0), 
-                        "wise_bites_score": record.get("wise_bites_score", 0), 
-                        "ai_summary": record.get("ai_summary", "No summary available."), 
-                        "is_dedicated_gluten_free": record.get("is_dedicated_gluten_free", False),
-                        "source": "Cache (Google) + Live (WiseBites)"
-                    }
-        except Exception as e:
-            logger.error(f"Supabase Read Error: {e}")
+    # B. Fetch Community Reviews LIVE (Always Fresh)
+    wb_reviews, wb_avg, wb_safe_free, wb_safe_prem, wb_dedi, wb_unsafe_free, wb_unsafe_prem, wb_count = format_community_reviews(req.place_id)
+    
+    # C. Combine for Frontend Display
+    combined_reviews = cached_google_reviews + wb_reviews
+
+    # Recalculate Total Count
+    google_count = int(record.get("relevant_count") or 0)
+
+    return {
+        "reviews": combined_reviews, # Return BOTH
+        "relevant_count": google_count + wb_count,
+        "average_safety_rating": record.get("average_safety_rating"),
+        "ai_safety_score": record.get("ai_safety_score", 0), 
+        "wise_bites_score": record.get("wise_bites_score", 0), 
+        "ai_summary": record.get("ai_summary", "No summary available."), 
+        "is_dedicated_gluten_free": record.get("is_dedicated_gluten_free", False),
+        "last_updated": record.get("last_updated"),
+        "community_review_count": wb_count,
+        "source": "Cache (Google) + Live (WiseBites)"
+    }
+
+def deferred_reviews_payload(req: ReviewRequest, record: Optional[dict]) -> Optional[dict]:
+    """What a shed refresh gets instead: the stale analysis (None when there is nothing stored)"""
+    payload = cached_reviews_payload(req, record, allow_stale=True)
+    if payload:
+        payload.update({"deferred": True, "source": "Cache (stale, analysis deferred) + Live (WiseBites)"})
+    return payload
+
+def shed_reviews_response(req: ReviewRequest, record: Optional[dict]) -> dict:
+    deferred = deferred_reviews_payload(req, record)
+    if deferred:
+        return deferred
+    raise HTTPException(status_code=503, detail="Analysis queue is full, try again shortly.",
+                        headers={"Retry-After": str(ANALYSIS_RETRY_AFTER_SECONDS)})
+
+def review_request_metadata(req: ReviewRequest, record: Optional[dict]) -> dict:
+    """
+    Place metadata the request actually carries. Defaults ("Unknown", 0.0, None) only go into
+    a brand-new row; they never overwrite what an existing row (and the spatial index) holds.
+    """
+    metadata = {
+        "name": req.name,
+        "address": req.address,
+        "city": req.city or extract_city(req.address),
+        "rating": req.rating,
+        "lat": req.lat,
+        "lng": req.lng,
+        "hours_schedule": req.hours_schedule,
+        "hours_intervals": parse_hours_schedule(req.hours_schedule),
+    }
+    if record is None:
+        return metadata
+    return {k: v for k, v in metadata.items() if v not in (None, "Unknown", "", 0.0)}
 
+def refresh_review_steps(req: ReviewRequest, record: Optional[dict], stream: bool = False):
+    """Full SerpApi + Groq refresh. Yields (event, data) as it goes, returns the final payload."""
     # 2. FETCH GOOGLE DATA
-    # print("Fetching fresh data from SerpApi...")
-    raw_reviews = fetch_serpapi_reviews(req.place_id)
-    
-    google_reviews = []
-    total_rating_sum = 0
-    google_relevant_count = 0
+    # Incremental when we already hold reviews for this place: only unseen ones come back
+    stored_reviews = load_stored_reviews(req.place_id) if record else []
+    wb_reviews, wb_avg, wb_safe_free, wb_safe_prem, wb_dedi, wb_unsafe_free, wb_unsafe_prem, wb_count = format_community_reviews(req.place_id)
+
+    # What we already hold goes out first (the streaming variant renders it while SerpApi + Groq run)
+    yield "reviews", {
+        "reviews": stored_reviews + wb_reviews,
+        "ai_summary": (record or {}).get("ai_summary"),
+        "ai_safety_score": (record or {}).get("ai_safety_score"),
+        "wise_bites_score": (record or {}).get("wise_bites_score"),
+        "community_review_count": wb_count,
+        "stale": True
+    }
+
+    # Only incremental while we actually hold reviews: a failed review write (or an empty
+    # place) falls back to a full first page instead of skipping everything as "seen"
+    known_ids = None
+    if record and stored_reviews:
+        known_ids = set((record or {}).get("serpapi_review_ids") or [])
+        known_ids.update(k for r in stored_reviews for k in review_keys(r))
+    raw_reviews = fetch_serpapi_reviews(req.place_id, known_ids, (record or {}).get("newest_review_date"))
     
+    new_google_reviews = []
     for r in raw_reviews:
         text_content = r.get("snippet", "")
         rating = r.get("rating", 0)
         if not text_content: continue 
-        google_relevant_count += 1
-        total_rating_sum += rating
-        google_reviews.append({
+        new_google_reviews.append(annotate_relevance({
             "source": "Google",
+            "review_id": r.get("review_id"),
             "text": text_content,
             "rating": rating,
             "author": r.get("user", {}).get("name", "Anonymous"),
             "date": r.get("date", ""),
+            "iso_date": r.get("iso_date"),
             "relevant": True
-        })
+        }))
 
-    wb_reviews, wb_avg, wb_safe_free, wb_safe_prem, wb_dedi, wb_unsafe_free, wb_unsafe_prem, wb_count = format_community_reviews(req.place_id)
+    google_reviews = merge_google_reviews(new_google_reviews, stored_reviews)
+    google_relevant_count = len(google_reviews)
+    total_rating_sum = sum(r.get("rating") or 0 for r in google_reviews)
+
+    seen_ids = sorted((known_ids or set()) | {review_key(r) for r in google_reviews})
+    review_dates = [d for d in (parse_timestamp(r.get("iso_date")) for r in google_reviews) if d]
+    newest_seen = parse_timestamp((record or {}).get("newest_review_date"))
+    if review_dates and (newest_seen is None or max(review_dates) > newest_seen):
+        newest_seen = max(review_dates)
 
     # Calculate Google-only Stats
     avg_safety_rating = 0
@@ -906,7 +4008,18 @@ def get_reviews(req: ReviewRequest):
     # 3. RUN AI ANALYSIS
     # print("Running AI Analysis...")
     all_reviews_for_ai = google_reviews + wb_reviews
-    ai_score, ai_summary = analyze_reviews_with_ai(all_reviews_for_ai)
+    if stream:
+        ai_score, ai_summary = yield from stream_review_analysis(all_reviews_for_ai)
+    else:
+        ai_score, ai_summary = analyze_reviews_with_ai(all_reviews_for_ai)
+
+    # A failed analysis is never persisted: stored, it would pass for a fresh one for 30 days.
+    # Serve the previous analysis (deferred) if there is one; either way the next read retries.
+    analyzed = ai_score is not None
+    if not analyzed:
+        if (record or {}).get("ai_summary"):
+            return deferred_reviews_payload(req, record)
+        ai_score = 0
 
     # --- CALCULATE SCORE ---
     final_wb_score = calculate_wisebites_score(
@@ -922,33 +4035,48 @@ def get_reviews(req: ReviewRequest):
     )
 
     # 4. SAVE TO SUPABASE
-    try:
-        upsert_data = {
-            "place_id": req.place_id,
-            "google_place_id": req.place_id, 
-            "name": req.name,
-            "address": req.address,
-            "city": req.city or extract_city(req.address),
-            "rating": req.rating,
-            "lat": req.lat,
-            "lng": req.lng,
-            "hours_schedule": req.hours_schedule,
+    saved_at = None
+    if analyzed:
+        try:
+            upsert_data = {
+                "place_id": req.place_id,
+                "google_place_id": req.place_id, 
+                **review_request_metadata(req, record),
             
+                # Google reviews are stored out-of-row (restaurant_reviews), see save_stored_reviews.
+                # serpapi_review_ids / newest_review_date are written only once those are saved.
+
+                "relevant_count": google_relevant_count, # Google only count
+                "community_review_count": wb_count,      # Separate column
+                "average_safety_rating": avg_safety_rating, 
+                "ai_safety_score": ai_score, 
+                "wise_bites_score": final_wb_score,
+                "ai_summary": ai_summary,    
+                "needs_resummary": False,
+                "last_updated": datetime.now(timezone.utc).isoformat()
+            }
+            if req.time_zone:
+                upsert_data["time_zone"] = req.time_zone
+            supabase.table("restaurants").upsert(upsert_data).execute()
+            saved_at = upsert_data["last_updated"]
+            suggest_index.put(upsert_data)
+            review_text_index.put(req.place_id, google_reviews + wb_reviews, ai_summary)
+        except Exception as e:
+            logger.error(f"Supabase Write Error: {e}")
+
+    if saved_at:
+        try:
             # --- CRITICAL FIX: Only save Google Reviews to DB ---
-            "reviews": google_reviews if google_reviews else [],
-            # ----------------------------------------------------
-            
-            "relevant_count": google_relevant_count, # Google only count
-            "community_review_count": wb_count,      # Separate column
-            "average_safety_rating": avg_safety_rating, 
-            "ai_safety_score": ai_score, 
-            "wise_bites_score": final_wb_score,
-            "ai_summary": ai_summary,    
-            "last_updated": datetime.now(timezone.utc).isoformat()
-        }
-        supabase.table("restaurants").upsert(upsert_data).execute()
-    except Exception as e:
-        logger.error(f"Supabase Write Error: {e}")
+            save_stored_reviews(req.place_id, google_reviews)
+            supabase.table("restaurants").update({
+                "serpapi_review_ids": seen_ids,
+                "newest_review_date": newest_seen.isoformat() if newest_seen else None,
+            }).eq("place_id", req.place_id).execute()
+        except Exception as e:
+            logger.error(f"Stored Reviews Write Error for {req.place_id}: {e}")
+
+    # New analysis (and whatever community reviews triggered it) -> cached searches are stale
+    invalidate_search_cache(req.place_id, req.lat, req.lng)
 
     return {
         "reviews": google_reviews, 
@@ -957,5 +4085,509 @@ def get_reviews(req: ReviewRequest):
         "ai_safety_score": ai_score,
         "wise_bites_score": final_wb_score,
         "ai_summary": ai_summary,
+        "last_updated": saved_at,
+        "community_review_count": wb_count,
         "source": "SerpApi + Groq"
-    }
\ No newline at end of file
+    }
+
+def run_review_steps(steps) -> dict:
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+@app.post("/api/reviews")
+def get_reviews(req: ReviewRequest, http_response: Response, x_profile_token: Optional[str] = Header(None)):
+    record_inbound("reviews", req)
+    with profile_request("reviews", x_profile_token, http_response):
+        return handle_reviews(req)
+
+def handle_reviews(req: ReviewRequest):
+    record = read_review_record(req.place_id)
+
+    if wants_community_rescore(req, record):
+        return rescore_from_community(req, record)
+
+    # 1. CHECK CACHE (Skip if force_refresh is True)
+    cached = cached_reviews_payload(req, record)
+    if cached:
+        return cached
+
+    # 2. ONE ANALYSIS PER PLACE: attach to a running one (e.g. a search prefetch) if there is one
+    outcome, result, record = lead_or_attach(req, record)
+    if outcome == "done":
+        return result
+    if outcome == "shed":
+        return shed_reviews_response(req, record)
+    future = result
+
+    payload = None
+    try:
+        if not analysis_gate.acquire(analysis_priority(req)):
+            return shed_reviews_response(req, record)
+        try:
+            payload = run_review_steps(refresh_review_steps(req, record))
+            return payload
+        finally:
+            analysis_gate.release()
+    finally:
+        settle_analysis(req.place_id, future, payload)
+
+# --- STREAMING VARIANT ---
+# Same request and final payload as POST /api/reviews, as Server-Sent Events:
+#   reviews - stored Google + live community reviews (and the previous summary), right away
+#   summary - summary text deltas while Groq generates
+#   done    - the final /api/reviews payload, once it is persisted
+# Cache hits and community-only re-scores are a single `done` event. A leader's analysis runs
+# on its own thread and the response only relays its events, so a client that disconnects
+# mid-summary doesn't throw away the paid SerpApi + Groq work: it still persists.
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def sse_shed_event(req: ReviewRequest, record: Optional[dict]) -> str:
+    deferred = deferred_reviews_payload(req, record)
+    if deferred:
+        return sse_event("done", deferred)
+    return sse_event("error", {"status": 503, "retry_after": ANALYSIS_RETRY_AFTER_SECONDS})
+
+def stream_analysis_worker(req: ReviewRequest, record: Optional[dict], future: Future, events: queue.Queue):
+    """Leader of a streamed analysis: puts (event, data) pairs, then ("done", payload or None)"""
+    payload = None
+    try:
+        if not analysis_gate.acquire(analysis_priority(req)):
+            return
+        try:
+            steps = refresh_review_steps(req, record, stream=True)
+            while True:
+                try:
+                    event, data = next(steps)
+                except StopIteration as done:
+                    payload = done.value
+                    break
+                events.put((event, data))
+        finally:
+            analysis_gate.release()
+    except Exception as e:
+        logger.error(f"Streamed Analysis Error for {req.place_id}: {e}")
+    finally:
+        settle_analysis(req.place_id, future, payload)
+        events.put(("done", payload))
+
+@app.post("/api/reviews/stream")
+def stream_reviews(req: ReviewRequest):
+    def events():
+        try:
+            record = read_review_record(req.place_id)
+        except HTTPException as e:
+            yield sse_event("error", {"status": e.status_code, "retry_after": REVIEW_STORE_RETRY_AFTER_SECONDS})
+            return
+        if wants_community_rescore(req, record):
+            yield sse_event("done", rescore_from_community(req, record))
+            return
+        cached = cached_reviews_payload(req, record)
+        if cached:
+            yield sse_event("done", cached)
+            return
+
+        # Attached callers don't get tokens, just the finished payload
+        outcome, result, record = lead_or_attach(req, record)
+        if outcome != "lead":
+            yield sse_event("done", result) if outcome == "done" else sse_shed_event(req, record)
+            return
+
+        pending = queue.Queue()
+        threading.Thread(target=stream_analysis_worker, args=(req, record, result, pending), daemon=True).start()
+        while True:
+            event, data = pending.get()
+            if event == "done": break
+            yield sse_event(event, data)
+        yield sse_event("done", data) if data else sse_shed_event(req, record)
+
+    # Headers go out before the first DB read; no-transform keeps proxies from buffering the stream
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"})
+
+
+# --- SPECULATIVE PREFETCH ---
+# A search already knows which uncached / stale places will be on screen first, so it starts
+# their analyses right away, at prefetch priority (an idle slot or nothing, never queued).
+# When the card asks a moment later it attaches to the in-flight analysis or finds the fresh
+# row. Budgets are per process and per rolling hour. Only long-lived workers benefit; where
+# the process is frozen after the response, cards still analyze on view as before.
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", "3"))
+PREFETCH_SCAN_DEPTH = 10          # Only the first screenful is worth guessing at
+PREFETCH_USER_BUDGET = 20         # Per signed-in user
+PREFETCH_GLOBAL_BUDGET = 200
+PREFETCH_WINDOW_SECONDS = 3600
+
+prefetch_stats = {"scheduled": 0, "completed": 0, "skipped_fresh": 0, "skipped_inflight": 0,
+                  "skipped_busy": 0, "skipped_budget": 0, "shed": 0, "errors": 0}
+_prefetch_stats_lock = threading.Lock()
+prefetch_executor = ThreadPoolExecutor(max_workers=ANALYSIS_MAX_CONCURRENCY, thread_name_prefix="prefetch")
+
+def _count_prefetch(stat: str):
+    with _prefetch_stats_lock:
+        prefetch_stats[stat] += 1
+
+class RollingBudget:
+    """At most `limit` uses per key in any rolling window"""
+    def __init__(self, limit: int, window_seconds: float):
+        self.limit = limit
+        self.window = window_seconds
+        self._uses = {}   # key -> deque of timestamps
+
+    def _recent(self, key, now: float):
+        uses = self._uses.setdefault(key, deque())
+        while uses and uses[0] <= now - self.window:
+            uses.popleft()
+        return uses
+
+    def available(self, key, now: float) -> bool:
+        return len(self._recent(key, now)) < self.limit
+
+    def use(self, key, now: float):
+        self._recent(key, now).append(now)
+
+_prefetch_user_budget = RollingBudget(PREFETCH_USER_BUDGET, PREFETCH_WINDOW_SECONDS)
+_prefetch_global_budget = RollingBudget(PREFETCH_GLOBAL_BUDGET, PREFETCH_WINDOW_SECONDS)
+_prefetch_lock = threading.Lock()
+
+def take_prefetch_budget(user_id: Optional[str]) -> bool:
+    """Anonymous searches only draw on the global budget"""
+    now = time.time()
+    with _prefetch_lock:
+        if not _prefetch_global_budget.available("*", now):
+            return False
+        if user_id and not _prefetch_user_budget.available(user_id, now):
+            return False
+        _prefetch_global_budget.use("*", now)
+        if user_id:
+            _prefetch_user_budget.use(user_id, now)
+        return True
+
+def prefetch_analysis(req: ReviewRequest, future: Future):
+    """Runs as the leader of an analysis schedule_prefetch already claimed"""
+    payload = None
+    try:
+        record = read_review_record(req.place_id)
+        if record and record_is_fresh(record):
+            _count_prefetch("skipped_fresh")
+            return
+        if not analysis_gate.acquire(PRIORITY_PREFETCH):
+            _count_prefetch("shed")
+            return
+        try:
+            payload = run_review_steps(refresh_review_steps(req, record))
+            _count_prefetch("completed")
+        finally:
+            analysis_gate.release()
+    except Exception as e:
+        _count_prefetch("errors")
+        logger.error(f"Prefetch Error for {req.place_id}: {e}")
+    finally:
+        settle_analysis(req.place_id, future, payload)
+
+def schedule_prefetch(results: List[dict], user_id: Optional[str]):
+    """Starts background analyses for the first few uncached / stale results"""
+    picked = [r for r in results[:PREFETCH_SCAN_DEPTH] if not r.get("is_cached")][:PREFETCH_TOP_N]
+    for r in picked:
+        if r["place_id"] in _inflight_analyses:
+            _count_prefetch("skipped_inflight")
+            continue
+        if not analysis_gate.has_idle_slot():
+            _count_prefetch("skipped_busy")
+            break
+        if not take_prefetch_budget(user_id):
+            _count_prefetch("skipped_budget")
+            break
+        # Claimed here, not in the worker, so a card asking right after the search already attaches
+        future, leader = claim_analysis(r["place_id"])
+        if not leader:
+            _count_prefetch("skipped_inflight")
+            continue
+        location = r.get("location") or {}
+        prefetch_executor.submit(prefetch_analysis, ReviewRequest(
+            place_id=r["place_id"],
+            name=r.get("name") or "Unknown",
+            address=r.get("address") or "Unknown",
+            city=r.get("city"),
+            rating=r.get("rating") or 0.0,
+            hours_schedule=r.get("hours_schedule") or None,
+            lat=location.get("lat"),
+            lng=location.get("lng"),
+            user_id=user_id,
+            context="prefetch",
+        ), future)
+        _count_prefetch("scheduled")
+
+# --- CDN-FRIENDLY GET VARIANT ---
+# Read-only view of the stored analysis, cacheable at Vercel's edge. It never refreshes
+# (no SerpApi/Groq, no writes): a missing or stale analysis is the POST's job. The ETag only
+# changes when the analysis is rewritten (last_updated) or a community review lands (count).
+# The body also carries the place itself (REVIEW_PLACE_FIELDS) so the detail page needs no
+# other read. Metadata-only writes (hours backfilled by a search) keep the ETag: the edge shows
+# them from the next analysis or community review on.
+REVIEWS_CDN_MAX_AGE = 3600              # Edge serves without invoking us for an hour...
+REVIEWS_CDN_STALE_WHILE_REVALIDATE = 86400  # ...then revalidates in the background
+
+def reviews_etag(place_id: str, last_updated: Optional[str], community_count: int) -> Optional[str]:
+    if not last_updated: return None
+    digest = hashlib.sha1(f"{place_id}|{last_updated}|{community_count}".encode()).hexdigest()
+    return f'"{digest[:20]}"'
+
+def current_reviews_etag(place_id: str) -> Optional[str]:
+    """Two tiny reads (no review text) -> ETag of what GET would return right now"""
+    try:
+        row = supabase.table("restaurants").select("last_updated,needs_resummary").eq("place_id", place_id).limit(1).execute()
+        if not row.data or not record_is_fresh(row.data[0]):
+            return None
+        wb = supabase.table("user_reviews").select("id", count="exact", head=True).eq("place_id", place_id).execute()
+        return reviews_etag(place_id, row.data[0].get("last_updated"), wb.count or 0)
+    except Exception as e:
+        logger.error(f"ETag Lookup Error: {e}")
+        return None
+
+def reviews_cache_headers(etag: Optional[str]) -> dict:
+    if not etag:
+        return {"Cache-Control": "no-store"}
+    return {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age=0, s-maxage={REVIEWS_CDN_MAX_AGE}, "
+                         f"stale-while-revalidate={REVIEWS_CDN_STALE_WHILE_REVALIDATE}",
+    }
+
+@app.get("/api/reviews")
+def get_reviews_cacheable(
+    http_response: Response,
+    place_id: str,
+    if_none_match: Optional[str] = Header(None),
+):
+    # Revalidation: answer 304 without building the payload
+    if if_none_match:
+        etag = current_reviews_etag(place_id)
+        if etag and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=reviews_cache_headers(etag))
+
+    record = read_review_record(place_id)
+    if not record or not record.get("last_updated"):
+        raise HTTPException(status_code=404, detail="No stored analysis for this place.",
+                            headers=reviews_cache_headers(None))
+
+    req = ReviewRequest(place_id=place_id)
+    if record_is_fresh(record):
+        body = cached_reviews_payload(req, record)
+        etag = reviews_etag(place_id, body.get("last_updated"), body.get("community_review_count", 0))
+    else:
+        # Stale or re-summary pending: serve it marked deferred, but keep it off the edge
+        body = deferred_reviews_payload(req, record)
+        etag = None
+    http_response.headers.update(reviews_cache_headers(etag))
+    return {**{k: record.get(k) for k in REVIEW_PLACE_FIELDS}, **body}
+
+
+# --- MAP VIEWPORT TILES ---
+# Map views read slippy-map tiles (z/x/y) of analyzed restaurants instead of running searches.
+# Up to VIEWPORT_CLUSTER_MAX_ZOOM a tile is an 8x8 grid of clusters (count, best score,
+# centroid); deeper tiles hold compact points. Clusters for every zoom are precomputed from the
+# spatial index (or the snapshot) and rebuilt on a background thread when that source changes,
+# so serving a tile is a dict lookup; the previous grid keeps serving until the new one is
+# swapped in (only the very first build answers 503 "warming up"). /api/tiles is CDN-cacheable; /api/viewport assembles the tiles covering a bbox.
+VIEWPORT_CLUSTER_MAX_ZOOM = 12
+VIEWPORT_POINT_ZOOM = VIEWPORT_CLUSTER_MAX_ZOOM + 1   # Points are bucketed by their tile at this zoom
+VIEWPORT_MAX_ZOOM = 20
+VIEWPORT_CLUSTER_BITS = 3        # 2^3 x 2^3 cluster cells per tile
+VIEWPORT_MAX_TILES = 64          # Per /api/viewport request
+VIEWPORT_CDN_MAX_AGE = 300
+VIEWPORT_CDN_STALE_WHILE_REVALIDATE = 3600
+MERCATOR_MAX_LAT = 85.05112878
+
+def mercator_xy(lat: float, lng: float):
+    """Position as a fraction of the Web Mercator world square, (0, 0) = top-left"""
+    lat = max(-MERCATOR_MAX_LAT, min(MERCATOR_MAX_LAT, lat))
+    sin_lat = math.sin(math.radians(lat))
+    x = (lng + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    edge = 1 - 1e-12
+    return min(max(x, 0.0), edge), min(max(y, 0.0), edge)
+
+def tile_for(lat: float, lng: float, zoom: int):
+    mx, my = mercator_xy(lat, lng)
+    n = 1 << zoom
+    return int(mx * n), int(my * n)
+
+class ViewportGrid:
+    def __init__(self):
+        self.version = None
+        self.clusters = {}   # (z, tile_x, tile_y) -> {(cell_x, cell_y): [count, sum_lat, sum_lng, best_score, best_id]}
+        self.points = {}     # (tile_x, tile_y) at VIEWPORT_POINT_ZOOM -> [(mx, my, point)]
+        self._lock = threading.Lock()
+        self._building = False
+
+    def _source(self):
+        """(version, rows loader) from the spatial index or the snapshot; (None, None) while cold"""
+        if spatial_index.is_ready():
+            return ("index", spatial_index.loaded_at, len(spatial_index.rows), spatial_index.max_updated), spatial_index.all_rows
+        snap = current_snapshot()
+        if snap:
+            return ("snapshot", snap.version), lambda: [snap.row(i) for i in range(snap.size)]
+        return None, None
+
+    def ensure_current(self) -> bool:
+        """True when there is a grid to serve, even a stale one (or one whose source went cold)"""
+        version, load_rows = self._source()
+        if version is not None and version != self.version:
+            with self._lock:
+                start, self._building = not self._building, True
+            if start:
+                threading.Thread(target=self._rebuild, args=(load_rows, version), daemon=True).start()
+        return self.version is not None
+
+    def _rebuild(self, load_rows, version):
+        try:
+            self._build(load_rows(), version)
+        except Exception as e:
+            logger.error(f"Viewport Grid Build Error: {e}")
+        finally:
+            self._building = False
+
+    def _build(self, rows: List[dict], version):
+        started = time.perf_counter()
+        clusters, points = {}, {}
+        for r in rows:
+            lat, lng = r.get("lat"), r.get("lng")
+            if lat is None or lng is None: continue
+            mx, my = mercator_xy(lat, lng)
+            score = float(r["wise_bites_score"]) if r.get("wise_bites_score") else None
+            for z in range(VIEWPORT_CLUSTER_MAX_ZOOM + 1):
+                n = 1 << (z + VIEWPORT_CLUSTER_BITS)
+                cx, cy = int(mx * n), int(my * n)
+                tile = clusters.setdefault((z, cx >> VIEWPORT_CLUSTER_BITS, cy >> VIEWPORT_CLUSTER_BITS), {})
+                agg = tile.get((cx, cy))
+                if agg is None:
+                    tile[(cx, cy)] = [1, lat, lng, score, r["place_id"]]
+                    continue
+                agg[0] += 1
+                agg[1] += lat
+                agg[2] += lng
+                if score is not None and (agg[3] is None or score > agg[3]):
+                    agg[3], agg[4] = score, r["place_id"]
+            n = 1 << VIEWPORT_POINT_ZOOM
+            points.setdefault((int(mx * n), int(my * n)), []).append((mx, my, {
+                "place_id": r["place_id"],
+                "name": r.get("name"),
+                "lat": round(lat, 5),
+                "lng": round(lng, 5),
+                "wise_bites_score": score,
+                "is_dedicated_gluten_free": bool(r.get("is_dedicated_gluten_free")),
+            }))
+        # Swap whole structures: readers never see a half-built grid
+        self.clusters, self.points, self.version = clusters, points, version
+        logger.info(f"Viewport grid built: {len(rows)} rows, {len(clusters)} cluster tiles "
+                    f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def tile(self, z: int, x: int, y: int) -> dict:
+        if z <= VIEWPORT_CLUSTER_MAX_ZOOM:
+            cells = self.clusters.get((z, x, y), {})
+            return {"z": z, "x": x, "y": y, "mode": "clusters", "clusters": [
+                {"lat": round(agg[1] / agg[0], 5), "lng": round(agg[2] / agg[0], 5), "count": agg[0],
+                 "best_score": agg[3], "best_place_id": agg[4]}
+                for agg in cells.values()
+            ]}
+        shift = z - VIEWPORT_POINT_ZOOM
+        n = 1 << z
+        candidates = self.points.get((x >> shift, y >> shift), [])
+        return {"z": z, "x": x, "y": y, "mode": "points", "points": [
+            point for mx, my, point in candidates if int(mx * n) == x and int(my * n) == y
+        ]}
+
+viewport_grid = ViewportGrid()
+
+def _require_viewport_grid():
+    if not viewport_grid.ensure_current():
+        raise HTTPException(status_code=503, detail="Map data is warming up, try again shortly.",
+                            headers={"Retry-After": "5"})
+
+@app.get("/api/tiles/{z}/{x}/{y}")
+def get_viewport_tile(z: int, x: int, y: int, http_response: Response,
+                      if_none_match: Optional[str] = Header(None)):
+    if not (0 <= z <= VIEWPORT_MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        raise HTTPException(status_code=400, detail="Tile out of range")
+    _require_viewport_grid()
+    cache_control = f"public, max-age=0, s-maxage={VIEWPORT_CDN_MAX_AGE}, " \
+                    f"stale-while-revalidate={VIEWPORT_CDN_STALE_WHILE_REVALIDATE}"
+    http_response.headers["Cache-Control"] = cache_control
+    result = respond_with_etag(viewport_grid.tile(z, x, y), http_response, if_none_match)
+    if isinstance(result, Response):
+        result.headers["Cache-Control"] = cache_control
+    return result
+
+@app.get("/api/viewport")
+def get_viewport(min_lat: float, min_lng: float, max_lat: float, max_lng: float, zoom: int,
+                 http_response: Response, if_none_match: Optional[str] = Header(None)):
+    """Every tile covering the bounding box at this zoom (tiles are also served one by one at /api/tiles)"""
+    zoom = max(0, min(VIEWPORT_MAX_ZOOM, zoom))
+    if min_lat > max_lat or min_lng > max_lng:
+        raise HTTPException(status_code=400, detail="Bounding box must be min < max (antimeridian spans: split in two)")
+    x0, y0 = tile_for(max_lat, min_lng, zoom)   # Top-left
+    x1, y1 = tile_for(min_lat, max_lng, zoom)   # Bottom-right
+    if (x1 - x0 + 1) * (y1 - y0 + 1) > VIEWPORT_MAX_TILES:
+        raise HTTPException(status_code=400, detail="Viewport too large for this zoom")
+    _require_viewport_grid()
+
+    tiles = [viewport_grid.tile(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    body = {
+        "zoom": zoom,
+        "mode": "clusters" if zoom <= VIEWPORT_CLUSTER_MAX_ZOOM else "points",
+        "tiles": [t for t in tiles if t.get("clusters") or t.get("points")],
+    }
+    return respond_with_etag(body, http_response, if_none_match)
+
+# --- METRICS ---
+# Metrics and saved profiles (stacks, timings) need X-Metrics-Token; without METRICS_TOKEN
+# configured both endpoints don't exist.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def require_metrics_token(x_metrics_token: Optional[str]):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_metrics_token or not hmac.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.get("/api/metrics")
+def get_metrics(x_metrics_token: Optional[str] = Header(None)):
+    require_metrics_token(x_metrics_token)
+    return {
+        "geocoding": geocode_hit_rates(),
+        "cache": cache_stats(),
+        "planner": planner_stats,
+        "analysis_queue": analysis_gate.snapshot(),
+        "prefetch": {**prefetch_stats, "inflight": inflight_stats},
+        "upstream": {"mode": UPSTREAM_MODE, **upstream_stats},
+        "google_places": {
+            **places_stats,
+            "calls_per_search": round(places_stats["api_calls"] / places_stats["searches"], 2) if places_stats["searches"] else None,
+        },
+    }
+
+
+# --- COMMAND LINE ---
+# Offline jobs and benchmarks: python api/index.py <command>
+COMMANDS = {
+    "bench-geo": benchmark_geo,
+    "export-snapshot": export_search_snapshot,
+    "backfill-coords": backfill_restaurant_coords,
+    "recompute-scores": recompute_scores,
+    "score-parity": score_parity,
+    "replay-load": replay_load,
+    "score-community-relevance": score_community_relevance,
+    "migrate-legacy-reviews": migrate_legacy_reviews,
+    "print-schema": print_schema,
+}
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in COMMANDS:
+        print(f"Usage: python api/index.py [{' | '.join(COMMANDS)}]")
+        sys.exit(1)
+    COMMANDS[command]()
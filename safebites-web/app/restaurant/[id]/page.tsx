@@ -273,8 +273,9 @@ export default function RestaurantDetailsPage() {
         setCurrentUserReview(myReview || null);
     }
 
-    // C. Fetch Restaurant Data
-    const { data: restaurantData } = await supabase.from("restaurants").select("*").eq("place_id", id).single();
+    // C. Fetch Restaurant Data (stored analysis + place details, edge-cacheable)
+    const res = await fetch(`/api/reviews?place_id=${encodeURIComponent(String(id))}`);
+    const restaurantData = res.ok ? await res.json() : null;
 
     if (restaurantData) {
       setPlace(restaurantData);
@@ -287,10 +288,10 @@ export default function RestaurantDetailsPage() {
       );
       setCalculatedScore(score);
 
-      if (restaurantData.reviews && Array.isArray(restaurantData.reviews)) {
-        const sorted = [...restaurantData.reviews].sort((a, b) => getDaysAgo(a.date) - getDaysAgo(b.date));
-        setSortedGoogleReviews(sorted);
-      }
+      // The API returns stored Google reviews followed by community ones; community reviews are shown from section A
+      const googleReviews = (restaurantData.reviews || []).filter((r: any) => r.source !== "WiseBites Community");
+      const sorted = [...googleReviews].sort((a, b) => getDaysAgo(a.date) - getDaysAgo(b.date));
+      setSortedGoogleReviews(sorted);
     }
     setLoading(false);
   }, [id, supabase]);
@@ -309,7 +310,9 @@ export default function RestaurantDetailsPage() {
                     address: place.address,
                     city: place.city,
                     rating: place.rating,
-                    force_refresh: true // Correct: Forces a fresh AI run
+                    context: "detail",
+                    force_refresh: true,
+                    community_only: true // Re-score from the new review; the server queues a re-summary if needed
                 })
             });
             
@@ -1,6 +1,6 @@
 "use client";
 
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useInView } from "react-intersection-observer";
 import { 
   MapPin, Star, ShieldCheck, AlertTriangle, Clock, Info, Heart, 
@@ -20,6 +20,7 @@ interface Restaurant {
   distance_miles: number | null;
   is_open_now: boolean | null;
   hours_schedule: string[];
+  time_zone?: string | null;
   ai_safety_score?: number | null;
   ai_summary?: string | null;
   relevant_count?: number;
@@ -58,6 +59,7 @@ export default function RestaurantCard({
   const [summary, setSummary] = useState<string | null>(place.ai_summary ?? null);
   const [loading, setLoading] = useState(!place.is_cached);
   const [hasFetched, setHasFetched] = useState(place.is_cached || false);
+  const shedRetries = useRef(0);
   const [wiseBitesScore, setWiseBitesScore] = useState<number | null>(place.wise_bites_score ?? null);
 
   // --- STATE: User Interaction (Initialized from Props) ---
@@ -170,30 +172,87 @@ export default function RestaurantCard({
     if (inView && !hasFetched && !place.is_cached) {
       setHasFetched(true);
       setLoading(true);
-      fetch("/api/reviews", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ 
-            place_id: place.place_id, 
-            name: place.name, 
-            address: place.address, 
-            city: place.city, 
-            rating: place.rating, 
-            hours_schedule: place.hours_schedule,
-            is_dedicated_gluten_free: place.is_dedicated_gluten_free
-        }),
-      })
-        .then((res) => res.json())
-        .then((data) => {
-          setSafetyScore(data.ai_safety_score || 0);
-          setSummary(data.ai_summary);
-          setRelevantCount(data.relevant_count || 0);
-          if (data.wise_bites_score && data.wise_bites_score > 0) setWiseBitesScore(data.wise_bites_score);
+      const applyFinal = (data: any) => {
+        setSafetyScore(data.ai_safety_score || 0);
+        setSummary(data.ai_summary);
+        setRelevantCount(data.relevant_count || 0);
+        if (data.wise_bites_score && data.wise_bites_score > 0) setWiseBitesScore(data.wise_bites_score);
+        setLoading(false);
+      };
+
+      // Streamed: the summary renders as it is generated, the final event carries the scores
+      const startStream = async () => {
+        // Premium users' analyses are queued ahead of other card loads
+        const userId = isPremium ? (await supabase.auth.getSession()).data.session?.user.id : undefined;
+        return fetch("/api/reviews/stream", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ 
+              place_id: place.place_id, 
+              name: place.name, 
+              address: place.address, 
+              city: place.city, 
+              rating: place.rating, 
+              hours_schedule: place.hours_schedule,
+              time_zone: place.time_zone,
+              is_dedicated_gluten_free: place.is_dedicated_gluten_free,
+              user_id: userId,
+              context: "card"
+          }),
+        });
+      };
+
+      // A fresh stored analysis comes from the edge-cacheable GET; anything else goes to the stream
+      const readStored = async () => {
+        const res = await fetch(`/api/reviews?place_id=${encodeURIComponent(place.place_id)}`);
+        if (!res.ok) return false;
+        const data = await res.json();
+        if (data.deferred) return false;
+        applyFinal(data);
+        return true;
+      };
+
+      readStored()
+        .catch(() => false)
+        .then((served) => served ? null : startStream())
+        .then(async (res) => {
+          if (!res) return;
+          if (!res.body) throw new Error("No stream");
+          const reader = res.body.getReader();
+          const decoder = new TextDecoder();
+          let buffer = "";
+          let streamed = "";
+          while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split("\n\n");
+            buffer = events.pop() || "";
+            for (const raw of events) {
+              const event = raw.match(/^event: (.*)$/m)?.[1];
+              const data = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] || "null");
+              if (event === "reviews" && data.ai_summary) {
+                setSummary(data.ai_summary);
+              } else if (event === "summary") {
+                streamed += data.text;
+                setSummary(streamed);
+                setLoading(false);
+              } else if (event === "done") {
+                applyFinal(data);
+              } else if (event === "error") {
+                // Shed by the analysis queue: fetch again once it has had time to drain
+                if (shedRetries.current < 3) {
+                  shedRetries.current += 1;
+                  setTimeout(() => setHasFetched(false), (data?.retry_after || 10) * 1000);
+                }
+              }
+            }
+          }
           setLoading(false);
         })
         .catch(() => setLoading(false));
     }
-  }, [inView, hasFetched, place]);
+  }, [inView, hasFetched, place, isPremium]);
 
   const handleAiFeedback = async (isHelpful: boolean) => {
     if (feedbackStatus !== "none") return;
@@ -152,7 +152,9 @@ function HomeContent() {
                 sort_by: currentSort,
                 filter_dedicated_gf: currentFilters.dedicated_gf,
                 filter_dedicated_fryer: currentFilters.dedicated_fryer,
-                filter_gf_menu: currentFilters.gf_menu
+                filter_gf_menu: currentFilters.gf_menu,
+                // Fallback for places whose time zone we don't know yet
+                utc_offset_minutes: -new Date().getTimezoneOffset()
             }),
         });
 
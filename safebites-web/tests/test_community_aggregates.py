@@ -0,0 +1,109 @@
+import importlib.util
+import os
+import random
+import sys
+
+import pytest
+
+API_DIR = os.path.join(os.path.dirname(__file__), "..", "api")
+
+
+@pytest.fixture(scope="module")
+def api():
+    # The module builds its clients at import; placeholders are enough, nothing is called
+    os.environ.setdefault("SUPABASE_URL", "https://example.supabase.co")
+    os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.x")
+    os.environ.setdefault("GROQ_API_KEY", "test")
+    sys.path.insert(0, API_DIR)
+    spec = importlib.util.spec_from_file_location("safebites_api", os.path.join(API_DIR, "index.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Table:
+    """Just enough of a postgrest query for paged reads. Like Postgres, rows that tie on the
+    order key come back in an arbitrary order, which differs from one query to the next."""
+
+    def __init__(self, rows, rng):
+        self.rows, self.rng = rows, rng
+        self.filters, self.order_key, self.bounds = [], None, None
+
+    def select(self, columns):
+        return self
+
+    def gt(self, key, value):
+        self.filters.append(lambda r: r[key] > value)
+        return self
+
+    def order(self, key, desc=False):
+        self.order_key = key
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end + 1)
+        return self
+
+    def limit(self, n):
+        self.bounds = (0, n)
+        return self
+
+    def execute(self):
+        rows = [r for r in self.rows if all(f(r) for f in self.filters)]
+        self.rng.shuffle(rows)
+        rows.sort(key=lambda r: r[self.order_key])
+        start, end = self.bounds or (0, len(rows))
+
+        class Response:
+            data = rows[start:end]
+        return Response()
+
+
+class Client:
+    def __init__(self, tables):
+        self.tables, self.rng = tables, random.Random(3)
+
+    def table(self, name):
+        return Table(self.tables[name], self.rng)
+
+
+def test_community_aggregates_survive_duplicate_timestamps(api, monkeypatch):
+    rng = random.Random(11)
+    reviews = [
+        {
+            "id": i,
+            "place_id": f"place-{rng.randrange(5)}",
+            "rating": rng.choice([1, 2, 3, 4, 5, None]),
+            "did_feel_safe": rng.choice([True, False, None]),
+            "is_dedicated_gluten_free": rng.random() < 0.3,
+            "profiles": {"is_premium": rng.random() < 0.4},
+            # Bulk imports and same-second inserts share timestamps
+            "created_at": f"2026-01-0{1 + i // 10}T00:00:00+00:00",
+        }
+        for i in range(1, 48)
+    ]
+    monkeypatch.setattr(api, "supabase", Client({"user_reviews": reviews}))
+
+    expected = {}
+    for r in reviews:
+        expected.setdefault(r["place_id"], []).append(r)
+    expected = {pid: api.tally_community_reviews(rows) for pid, rows in expected.items()}
+
+    for page_size in (1, 4, 10, 100):
+        assert api.load_community_aggregates(page_size=page_size) == expected
+
+
+def test_score_batch_matches_scalar_scores(api):
+    rng = random.Random(7)
+    cols = [[] for _ in range(9)]
+    for _ in range(2000):
+        row = (
+            rng.choice([None, 0, 3.5, round(rng.uniform(0, 10), 1)]),
+            rng.choice([None, round(rng.uniform(0, 5), 1)]),
+            rng.choice([None, 0, 1, 3, 4, 50]),
+            rng.choice([0, 2.5, 13 / 3, 5]),
+            *(rng.choice([0, 0, 1, 3]) for _ in range(5)),
+        )
+        for col, value in zip(cols, row):
+            col.append(value)
+    assert api.score_batch(*cols) == [api.calculate_wisebites_score(*args) for args in zip(*cols)]